@@ -0,0 +1,66 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from unittest import mock
+import os
+
+# First Party
+import aconfig
+
+# Local
+from train_conductor.protobuf.trainconductor_pb2 import TrainingInfoRequest
+from train_conductor.training_servicer import TrainingServicer
+
+RUNTIME_CONFIG = os.path.join(
+    os.path.dirname(os.path.dirname(__file__)), "runtime_config.yml"
+)
+
+
+def make_servicer(admission_enabled: bool) -> TrainingServicer:
+    config = aconfig.Config.from_yaml(RUNTIME_CONFIG)
+    config.trainer_config.admission.enabled = admission_enabled
+    config.server.status_cache.max_size = 0
+    db_client = mock.Mock()
+    db_client.read_record.return_value = {"status": "QUEUED"}
+    db_client.admission_positions.return_value = {"job-1": 3}
+    db_client.read_durations.return_value = [600]
+    db_client.count_by_status.return_value = 2
+    with mock.patch(
+        "train_conductor.training_servicer.load_db_helper_class",
+        return_value=mock.Mock(return_value=db_client),
+    ):
+        return TrainingServicer(config)
+
+
+def test_status_has_no_queue_position_without_admission():
+    """Without admission there is no queue to report a position in"""
+    servicer = make_servicer(admission_enabled=False)
+    response = servicer.GetTrainingStatus(
+        TrainingInfoRequest(training_id="job-1"), None
+    )
+
+    assert not response.HasField("queue_position")
+    assert not response.HasField("estimated_start_timestamp")
+    servicer.db_client.admission_positions.assert_not_called()
+
+
+def test_status_has_queue_position_with_admission():
+    servicer = make_servicer(admission_enabled=True)
+    response = servicer.GetTrainingStatus(
+        TrainingInfoRequest(training_id="job-1"), None
+    )
+
+    assert response.queue_position == 3
+    assert response.HasField("estimated_start_timestamp")
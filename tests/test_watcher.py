@@ -0,0 +1,108 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from unittest import mock
+import json
+
+# Local
+from train_conductor.modules.job_cache import JobCache
+from train_conductor.modules.watcher import JOB_APP_LABEL, WATCH_CHECKPOINT, Watcher
+from train_conductor.modules.work_queue import KeyedWorkQueue
+
+
+class FakeWatchResponse:
+    """
+    Streaming response of a watch call, one JSON event per line
+    """
+
+    def __init__(self, events: list):
+        self.data = "".join(json.dumps(event) + "\n" for event in events).encode()
+
+    def stream(self, amt=None, decode_content=False):
+        yield self.data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+def make_watcher(events: list) -> Watcher:
+    def list_namespaced_job(**kwargs):
+        """
+        :return: V1JobList
+        """
+        return FakeWatchResponse(events)
+
+    watcher = Watcher.__new__(Watcher)
+    watcher.batch_v1_api = mock.Mock(list_namespaced_job=list_namespaced_job)
+    watcher.target_namespace = "ns"
+    watcher.job_cache = JobCache(
+        watcher.batch_v1_api, "ns", label_selector="app=" + JOB_APP_LABEL
+    )
+    watcher.job_cache.resume("100")
+    watcher.db_client = mock.Mock()
+    watcher.coordinator = mock.Mock(owns=lambda job_id: True)
+    watcher.admission = None
+    watcher._work_queue = KeyedWorkQueue()
+    watcher._last_checkpoint = 0
+    watcher._checkpoint_interval = 0
+    return watcher
+
+
+def job_event(event_type: str, job_id: str, resource_version: str) -> dict:
+    return {
+        "type": event_type,
+        "object": {
+            "apiVersion": "batch/v1",
+            "kind": "Job",
+            "metadata": {
+                "name": "train-conductor-tuning-job." + job_id,
+                "namespace": "ns",
+                "labels": {"app": JOB_APP_LABEL, "job_id": job_id},
+                "resourceVersion": resource_version,
+            },
+            "status": {},
+        },
+    }
+
+
+def test_monitor_jobs_moves_resource_version_on_bookmarks():
+    """Bookmarks checkpoint their resource version without ending the watch"""
+    bookmark = {
+        "type": "BOOKMARK",
+        "object": {
+            "apiVersion": "batch/v1",
+            "kind": "Job",
+            "metadata": {"resourceVersion": "150"},
+        },
+    }
+    watcher = make_watcher(
+        [job_event("ADDED", "a", "120"), bookmark, job_event("MODIFIED", "b", "160")]
+    )
+    with mock.patch("train_conductor.modules.watcher.logging.error") as log_error:
+        watcher.monitor_jobs()
+
+    log_error.assert_not_called()
+    checkpoints = [
+        call.args
+        for call in watcher.db_client.write_checkpoint.call_args_list
+        if call.args[0] == WATCH_CHECKPOINT
+    ]
+    assert [value for _, value in checkpoints] == ["120", "150", "160"]
+    assert watcher.job_cache.resource_version == "160"
+    assert set(watcher.job_cache.snapshot()) == {"a", "b"}
+    assert len(watcher._work_queue) == 2
@@ -12,6 +12,23 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# Standard
+import importlib
 
-from .training_servicer import TrainingServicer
-from .grpc_server import TrainingGRPCServer
+# Where the public classes are defined. They are imported when first used, so
+# that importing one module of the package doesn't pull in gRPC and the
+# Kubernetes client with the others.
+_EXPORTS = {
+    "TrainingServicer": ".training_servicer",
+    "TrainingGRPCServer": ".grpc_server",
+}
+
+
+def __getattr__(name: str):
+    if name not in _EXPORTS:
+        raise AttributeError("module {} has no attribute {}".format(__name__, name))
+    return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
@@ -0,0 +1,137 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+import asyncio
+
+# First Party
+from aconfig import Config
+
+# Third Party
+from google.protobuf.message import Message as ProtoMessageType
+from grpc.aio import ServicerContext
+
+# Local
+from train_conductor.protobuf.trainconductor_pb2 import BatchTrainingStatusResponse
+from train_conductor.training_servicer import TrainingServicer
+from train_conductor.utils import error_check as error
+from train_conductor.utils.helpers import load_db_helper_class
+
+
+class AsyncTrainingServicer(TrainingServicer):
+    """
+    TrainingServicer for the asyncio gRPC server. Status reads and watch
+    streams run on the event loop with the async datastore client, so they
+    don't tie up a thread each. The other methods are inherited and run on
+    the server's thread pool.
+    """
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        async_helper_cls = load_db_helper_class(self.config, "async_helper_class")
+        self.async_db_client = async_helper_cls(self.config)
+
+    async def GetTrainingStatus(
+        self, request: ProtoMessageType, context: ServicerContext
+    ):
+        """Get the status of a training job"""
+        try:
+            if self._status_cache is not None:
+                return await self._status_cache.get_or_load_async(
+                    request.training_id,
+                    lambda: self._read_status_async(request.training_id),
+                )
+            return await self._read_status_async(request.training_id)
+        except Exception as err:
+            raise Exception(
+                "Failed to get status for training id {}".format(request.training_id)
+            ) from err
+
+    async def BatchGetTrainingStatus(
+        self, request: ProtoMessageType, context: ServicerContext
+    ):
+        """Get the status of several training jobs"""
+        training_ids = list(dict.fromkeys(request.training_ids))
+        try:
+            error.value_check(
+                "<TCD71502288E>",
+                len(training_ids) <= self._max_batch_size,
+                "at most {} training ids can be requested at once",
+                self._max_batch_size,
+            )
+            records = await self.async_db_client.read_many_entries(training_ids)
+            return BatchTrainingStatusResponse(
+                statuses=await self._status_responses_async(records)
+            )
+        except Exception as err:
+            raise Exception("Failed to get status of training ids") from err
+
+    async def WatchTrainingStatus(
+        self, request: ProtoMessageType, context: ServicerContext
+    ):
+        """Stream the status of training jobs as it changes"""
+        training_ids = list(dict.fromkeys(request.training_ids))
+        try:
+            self._check_watch_ids(training_ids)
+            # Subscribe first, so that no change after the initial read is missed
+            subscription = self._change_feed.subscribe(
+                training_ids, asyncio.get_running_loop()
+            )
+        except Exception as err:
+            raise Exception("Failed to watch training status") from err
+
+        # A cancelled call raises CancelledError, which closes the subscription
+        try:
+            records = await self.async_db_client.read_many_entries(training_ids)
+            self._check_watched_exist(training_ids, records)
+
+            sent = {}
+            while True:
+                changed = self._status_changes(records, sent)
+                for response in await self._status_responses_async(changed):
+                    yield response
+                if self._all_finished(training_ids, sent) or subscription.closed:
+                    return
+                records = await subscription.get_async()
+        except Exception as err:
+            raise Exception(
+                "Failed to watch status of training ids {}".format(
+                    ", ".join(training_ids)
+                )
+            ) from err
+        finally:
+            subscription.close()
+
+    async def close(self):
+        self.stop()
+        await self.async_db_client.close()
+
+    async def _read_status_async(self, training_id: str):
+        training_info = await self.async_db_client.read_record(training_id)
+        return (await self._status_responses_async({training_id: training_info}))[0]
+
+    async def _status_responses_async(self, records: dict) -> list:
+        waiting = self._waiting(records)
+        positions = {}
+        if waiting:
+            positions = await self.async_db_client.admission_positions(waiting)
+            # Run time statistics are refreshed with the blocking client, off
+            # the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self._queue_stats)
+        return [
+            self._status_response(
+                training_id, training_info, positions.get(training_id)
+            )
+            for training_id, training_info in records.items()
+        ]
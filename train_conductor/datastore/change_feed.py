@@ -0,0 +1,174 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+import asyncio
+import threading
+
+# Local
+from train_conductor.datastore.database_base import DatabaseBase
+
+
+class ChangeFeed:
+    """
+    Hands the datastore's change notifications to any number of subscribers
+    in the process, through a single listener.
+
+    Listeners are called with the key of every changed record. Subscribers
+    are handed the changed records of the keys they watch. A changed record
+    is read once, however many subscribers watch it, and only if any does.
+    The datastore listener is started with the first listener or
+    subscription.
+    """
+
+    def __init__(self, db_client: DatabaseBase):
+        self.db_client = db_client
+        # Subscriptions by the key they watch
+        self._subscriptions = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def subscribe(self, keys: list, loop=None) -> "Subscription":
+        """
+        Watch the records of keys until the returned subscription is closed.
+        Subscribers on an asyncio event loop pass it as loop and use get_async.
+        """
+        subscription = Subscription(self, keys, loop)
+        with self._lock:
+            for key in subscription.keys:
+                self._subscriptions.setdefault(key, set()).add(subscription)
+            self._start()
+        return subscription
+
+    def add_listener(self, listener):
+        """
+        Call listener with the key of every changed record from now on
+        """
+        with self._lock:
+            self._listeners.append(listener)
+            self._start()
+
+    def unsubscribe(self, subscription: "Subscription"):
+        with self._lock:
+            for key in subscription.keys:
+                subscriptions = self._subscriptions.get(key)
+                if subscriptions is None:
+                    continue
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[key]
+
+    def stop(self):
+        """
+        Stop the listener and close all subscriptions
+        """
+        self._stop_event.set()
+        with self._lock:
+            subscriptions = set().union(*self._subscriptions.values())
+        for subscription in subscriptions:
+            subscription.close()
+
+    def _start(self):
+        """
+        Start the datastore listener if it is not running. Call with the lock held.
+        """
+        if not self._thread and not self._stop_event.is_set():
+            self._thread = self.db_client.start_listener(
+                self._handle, stop_event=self._stop_event
+            )
+
+    def _handle(self, key: str):
+        with self._lock:
+            listeners = list(self._listeners)
+            subscriptions = list(self._subscriptions.get(key, ()))
+        for listener in listeners:
+            listener(key)
+        if not subscriptions:
+            return
+        record = self.db_client.read_record(key)
+        for subscription in subscriptions:
+            subscription.put(key, record)
+
+
+class Subscription:
+    """
+    Records of the watched keys that changed since the subscriber last looked.
+    Only the latest version of each record is kept, so a slow subscriber holds
+    at most one record per key.
+    """
+
+    def __init__(self, feed: ChangeFeed, keys: list, loop=None):
+        self.feed = feed
+        self.keys = set(keys)
+        self._pending = {}
+        self._cond = threading.Condition()
+        self.closed = False
+        self._loop = loop
+        self._event = asyncio.Event() if loop else None
+
+    def put(self, key: str, record: dict):
+        with self._cond:
+            # Moved to the end, so records come out in the order they last changed
+            self._pending.pop(key, None)
+            self._pending[key] = record
+            self._cond.notify()
+        self._wake_loop()
+
+    def get(self, timeout: float = None) -> dict:
+        """
+        Wait for changes and return the changed records by key. Returns an
+        empty dict on timeout or once the subscription is closed.
+        """
+        with self._cond:
+            if not self._pending and not self.closed:
+                self._cond.wait(timeout)
+            pending = self._pending
+            self._pending = {}
+            return pending
+
+    async def get_async(self, timeout: float = None) -> dict:
+        """
+        Like get, without blocking the event loop
+        """
+        with self._cond:
+            waiting = not self._pending and not self.closed
+        if waiting:
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        # Cleared before draining, so a record put after the drain sets it again
+        self._event.clear()
+        with self._cond:
+            pending = self._pending
+            self._pending = {}
+            return pending
+
+    def close(self):
+        self.feed.unsubscribe(self)
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        self._wake_loop()
+
+    def _wake_loop(self):
+        if not self._loop:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            # The loop was closed, nobody waits on it anymore
+            pass
@@ -14,11 +14,46 @@
 import abc
 
 
+class RecordWrite:
+    """
+    A write to a single record, to be applied with DatabaseBase.write_batch. A
+    write with a status is applied like transition_status, otherwise like
+    write_fields.
+    """
+
+    def __init__(
+        self,
+        key: str,
+        fields: dict = None,
+        status=None,
+        expected=None,
+        notify: bool = True,
+    ):
+        self.key = key
+        self.fields = fields or {}
+        self.status = status
+        self.expected = expected
+        self.notify = notify
+
+
 class DatabaseBase(abc.ABC):
     @abc.abstractclassmethod
     def __init__(self, config: dict) -> None:
         super().__init__()
 
+    @abc.abstractclassmethod
+    def ping(self):
+        """
+        Check that the database can be reached, connecting to it if needed
+        """
+
+    @abc.abstractclassmethod
+    def pool_stats(self, reset: bool = False) -> dict:
+        """
+        Return the usage of the connection pool: connections in use and how
+        long getting one took. With reset, the peaks and times start over.
+        """
+
     @abc.abstractclassmethod
     def write_record(self, key: str, record: dict):
         """
@@ -43,6 +78,38 @@ class DatabaseBase(abc.ABC):
         Given an entry key and a field name, return value of field
         """
 
+    @abc.abstractclassmethod
+    def write_fields(self, key: str, mapping: dict, notify: bool = True):
+        """
+        Given an entry key and a mapping of field names to values, write all fields
+        at once. At most one change notification is sent, none if notify is False.
+        """
+
+    @abc.abstractclassmethod
+    def transition_status(
+        self,
+        key: str,
+        status,
+        expected=None,
+        fields: dict = None,
+        notify: bool = True,
+    ):
+        """
+        Atomically move a record to a new TrainingStatus, together with any extra
+        fields, if the move from its current status is allowed by VALID_TRANSITIONS
+        and, when expected is given, the current status is expected. Without
+        expected, a move to the status the record already has just writes the
+        fields. Returns whether the move was applied and the resulting record,
+        which is empty if the key does not exist.
+        """
+
+    @abc.abstractclassmethod
+    def write_batch(self, writes: list):
+        """
+        Given a list of RecordWrites, apply them all in as few round trips as
+        possible. Returns the result of each write, in order.
+        """
+
     @abc.abstractclassmethod
     def has_key(self, key: str) -> bool:
         """
@@ -55,11 +122,159 @@ class DatabaseBase(abc.ABC):
         Return an object that allows the caller to iterate over a list of records
         """
 
+    @abc.abstractclassmethod
+    def list_by_status(self, status, cursor=None, count: int = None):
+        """
+        Given a TrainingStatus, return a cursor and a batch of keys of the records
+        currently in that status
+        """
+
+    @abc.abstractclassmethod
+    def list_by_model(self, model_name: str, cursor=None, count: int = None):
+        """
+        Given a model name, return a cursor and a batch of keys of the records
+        of training jobs for that model
+        """
+
+    @abc.abstractclassmethod
+    def iterate_active_entries(self, cursor=None):
+        """
+        Return an object that allows the caller to iterate over the keys of records
+        that have been written since they were last marked inactive
+        """
+
+    @abc.abstractclassmethod
+    def mark_inactive(self, *keys: str):
+        """
+        Indicates that records need no further reconciliation until they are written again
+        """
+
+    @abc.abstractclassmethod
+    def index_entries(self, entries: dict):
+        """
+        Given records by key, as read from the database, add each one to the
+        indexes it belongs in. Unfinished records are marked active.
+        """
+
     @abc.abstractclassmethod
     def read_many_entries(keys):
         """
         Given a list of keys, return a list of records
         """
 
+    @abc.abstractclassmethod
+    def schedule_retry(self, key: str, due_at: float):
+        """
+        Schedule another reconcile of a record at due_at, in seconds since the
+        epoch, replacing any earlier schedule for it
+        """
+
+    @abc.abstractclassmethod
+    def due_retries(self, until: float, count: int = None) -> list:
+        """
+        Return the keys of up to count records scheduled for a retry at or before until
+        """
+
+    @abc.abstractclassmethod
+    def read_retries(self, keys: list) -> dict:
+        """
+        Given a list of keys, return when each of the scheduled ones is due
+        """
+
+    @abc.abstractclassmethod
+    def clear_retries(self, *keys: str):
+        """
+        Remove scheduled retries of records
+        """
+
+    @abc.abstractclassmethod
+    def enqueue_admission(self, scores: dict):
+        """
+        Given a dict of keys to scores, add the records to the admission queue,
+        ordered by ascending score. Records already queued keep their place.
+        """
+
+    @abc.abstractclassmethod
+    def read_admission_queue(self, count: int) -> list:
+        """
+        Return the keys of the first count records in the admission queue
+        """
+
+    @abc.abstractclassmethod
+    def dequeue_admission(self, *keys: str):
+        """
+        Remove records from the admission queue
+        """
+
+    @abc.abstractclassmethod
+    def admission_positions(self, keys: list) -> dict:
+        """
+        Given a list of keys, return the 0-based position of each record in the
+        admission queue by key, None for records that are not queued
+        """
+
+    @abc.abstractclassmethod
+    def count_backlog(self) -> int:
+        """
+        Return the number of records waiting for admission, including new
+        records not queued yet
+        """
+
+    @abc.abstractclassmethod
+    def count_by_status(self, status) -> int:
+        """
+        Given a TrainingStatus, return the number of records currently in that status
+        """
+
+    @abc.abstractclassmethod
+    def record_durations(self, *durations: float):
+        """
+        Keep the run times, in seconds, of recently finished jobs
+        """
+
+    @abc.abstractclassmethod
+    def read_durations(self) -> list:
+        """
+        Return the run times kept by record_durations, most recent first
+        """
+
+    @abc.abstractclassmethod
+    def write_checkpoint(self, name: str, value: str):
+        """
+        Store a named value that a component needs to resume from after a restart
+        """
+
+    @abc.abstractclassmethod
+    def read_checkpoint(self, name: str) -> str:
+        """
+        Given a checkpoint name, return its stored value, or None
+        """
+
+    @abc.abstractclassmethod
+    def acquire_lease(self, name: str, holder: str, ttl_ms: int) -> bool:
+        """
+        Take or renew a named lease for ttl_ms milliseconds. Returns whether the
+        holder owns the lease afterwards.
+        """
+
+    @abc.abstractclassmethod
+    def release_lease(self, name: str, holder: str):
+        """
+        Give up a named lease, if the holder owns it
+        """
+
+    @abc.abstractclassmethod
+    def register_member(self, group: str, member: str, ttl_ms: int) -> list:
+        """
+        Register a member of a named group for ttl_ms milliseconds, dropping any
+        members whose registration expired. Returns the live members.
+        """
+
+    @abc.abstractclassmethod
+    def unregister_member(self, group: str, member: str):
+        """
+        Remove a member from a named group
+        """
+
     def get_client(self):
         return self._client
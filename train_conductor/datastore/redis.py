@@ -13,92 +13,1235 @@
 # limitations under the License.
 
 # Standard
+from concurrent.futures import ThreadPoolExecutor
+import functools
 import os
 import logging
+import socket
+import threading
+import time
+import weakref
+import zlib
 
 # Third Party
+from redis.backoff import EqualJitterBackoff
+from redis.retry import Retry
 import redis
+import redis.asyncio
+import redis.asyncio.cluster
+import redis.asyncio.retry
+import redis.asyncio.sentinel
+import redis.cluster
+import redis.sentinel
 import aconfig
 
 # Local
-from train_conductor.datastore.database_base import DatabaseBase
+from train_conductor.datastore.database_base import DatabaseBase, RecordWrite
 from train_conductor.utils.error_check import type_check, file_check
+from train_conductor.types import TrainingStatus, COMPLETED_STATES, VALID_TRANSITIONS
+
+# Compare-and-set status transition, run server side so that the check, the
+# write, the index updates and the change notification happen atomically
+# KEYS: record, active set, one status index per ARGV[4] name, then the change
+#   stream if ARGV[5] is "1"
+# ARGV: new status, expected current status or "", space separated statuses
+#   the new status may be reached from, space separated status index names,
+#   "1" to notify, stream max length, origin or "", key of the record in the
+#   indexes and change notifications, then field/value pairs
+TRANSITION_SCRIPT = """
+if redis.call("EXISTS", KEYS[1]) == 0 then
+    return false
+end
+local current = redis.call("HGET", KEYS[1], "status") or "PLACEHOLDER_UNSET"
+-- Without an expected status, a move to the current status only writes the fields
+local unchanged = ARGV[1] == current and ARGV[2] == ""
+local allowed = unchanged
+if not unchanged and (ARGV[2] == "" or ARGV[2] == current) then
+    for status in string.gmatch(ARGV[3], "%S+") do
+        if status == current then
+            allowed = true
+        end
+    end
+end
+if not allowed then
+    return {0, redis.call("HGETALL", KEYS[1])}
+end
+
+if not unchanged then
+    redis.call("HSET", KEYS[1], "status", ARGV[1])
+end
+for i = 9, #ARGV, 2 do
+    redis.call("HSET", KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call("SADD", KEYS[2], ARGV[8])
+local index = 3
+for status in string.gmatch(ARGV[4], "%S+") do
+    if not unchanged then
+        if status == ARGV[1] then
+            redis.call("SADD", KEYS[index], ARGV[8])
+        else
+            redis.call("SREM", KEYS[index], ARGV[8])
+        end
+    end
+    index = index + 1
+end
+if ARGV[5] == "1" then
+    local event = {"key", ARGV[8]}
+    if ARGV[7] ~= "" then
+        event[3] = "origin"
+        event[4] = ARGV[7]
+    end
+    redis.call("XADD", KEYS[index], "MAXLEN", "~", ARGV[6], "*", unpack(event))
+end
+return {1, redis.call("HGETALL", KEYS[1])}
+"""
+
+# Add a record to the index of the status it has now, read server side so that
+# a concurrent transition can't leave it in a stale index
+# KEYS: record, one status index per ARGV[2] name
+# ARGV: key of the record in the indexes, space separated status index names
+INDEX_SCRIPT = """
+local current = redis.call("HGET", KEYS[1], "status")
+if not current then
+    return 0
+end
+local index = 2
+for status in string.gmatch(ARGV[2], "%S+") do
+    if status == current then
+        return redis.call("SADD", KEYS[index], ARGV[1])
+    end
+    index = index + 1
+end
+return 0
+"""
+
+# Take a lease if it is free, or extend it if the caller already holds it
+# KEYS: lease
+# ARGV: holder, time to live in milliseconds
+LEASE_SCRIPT = """
+local holder = redis.call("GET", KEYS[1])
+if holder == ARGV[1] then
+    redis.call("PEXPIRE", KEYS[1], ARGV[2])
+    return 1
+end
+if not holder then
+    redis.call("SET", KEYS[1], ARGV[1], "PX", ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# Delete a lease only if the caller holds it
+# KEYS: lease
+# ARGV: holder
+RELEASE_SCRIPT = """
+if redis.call("GET", KEYS[1]) == ARGV[1] then
+    return redis.call("DEL", KEYS[1])
+end
+return 0
+"""
+
+
+def connection_kwargs(config: aconfig.Config) -> dict:
+    """
+    Arguments for connecting a Redis client to the server in config
+    """
+    redis_config = config.datastore.connection
+    redis_host = redis_config.host
+    type_check("<TCD47773352E>", str, redis_host=redis_host)
+    redis_port = redis_config.port
+    type_check("<TCD47773353E>", int, redis_port=redis_port)
+    redis_db_num = redis_config.db_num
+    type_check("<TCD47773354E>", int, redis_db_num=redis_db_num)
+    user = redis_config.user or None
+    password = os.environ.get("REDIS_PASSWORD")
+    ca_cert = os.environ.get("REDIS_CA_FILE")
+    if ca_cert:
+        file_check("<TCD08017879E>", ca_cert)
+    ssl_enable = False
+    if ca_cert:
+        ssl_enable = True
+    return {
+        "host": redis_host,
+        "port": redis_port,
+        "db": redis_db_num,
+        "decode_responses": True,
+        "username": user,
+        "password": password,
+        "ssl_ca_certs": ca_cert,
+        "ssl": ssl_enable,
+        "socket_timeout": redis_config.socket_timeout or 5,
+        "socket_connect_timeout": redis_config.connect_timeout or 2,
+        "socket_keepalive": redis_config.get("socket_keepalive", True),
+        "health_check_interval": redis_config.get("health_check_interval", 30),
+    }
+
+
+def pool_kwargs(config: aconfig.Config, use_asyncio: bool = False, **overrides):
+    """
+    Arguments for a blocking pool of connections to the Redis server in
+    config. Once max_connections are in use, callers wait up to pool_timeout
+    seconds for one to be released. Commands that fail with a connection
+    error or a timeout are retried with exponential backoff, so a failover
+    that takes less than the retries doesn't fail the command.
+
+    overrides replace the connection arguments of connection_kwargs.
+    """
+    redis_config = config.datastore.connection
+    kwargs = connection_kwargs(config)
+    kwargs.update(overrides)
+    if not kwargs["ssl"]:
+        kwargs.pop("ssl_ca_certs")
+    backoff = EqualJitterBackoff(
+        cap=redis_config.retry_max_delay or 1,
+        base=redis_config.retry_base_delay or 0.05,
+    )
+    retries = redis_config.get("retries", 3)
+    if use_asyncio:
+        kwargs["retry"] = redis.asyncio.retry.Retry(backoff, retries)
+    else:
+        kwargs["retry"] = Retry(backoff, retries)
+    kwargs.setdefault("max_connections", redis_config.max_connections or 50)
+    kwargs.setdefault("timeout", redis_config.pool_timeout or 5)
+    return kwargs
+
+
+def connection_pool(config: aconfig.Config, use_asyncio: bool = False, **overrides):
+    """
+    Instrumented blocking pool with the arguments of pool_kwargs
+    """
+    kwargs = pool_kwargs(config, use_asyncio, **overrides)
+    # Pools take the connection class rather than the ssl flag of clients
+    if use_asyncio:
+        pool_class = AsyncInstrumentedConnectionPool
+        ssl_class = redis.asyncio.SSLConnection
+    else:
+        pool_class = InstrumentedConnectionPool
+        ssl_class = redis.SSLConnection
+    if kwargs.pop("ssl"):
+        kwargs["connection_class"] = ssl_class
+    return pool_class(**kwargs)
+
+
+class PoolStats:
+    """
+    Usage of a connection pool: connections in use, the most in use at once,
+    and how long getting a connection took, which includes waiting for one to
+    be released when the pool is exhausted
+    """
+
+    def __init__(self, max_connections: int):
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._in_use = 0
+        self._peak_in_use = 0
+        self._checkouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def checked_out(self, waited: float):
+        with self._lock:
+            self._in_use += 1
+            self._peak_in_use = max(self._peak_in_use, self._in_use)
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+
+    def released(self):
+        with self._lock:
+            self._in_use = max(self._in_use - 1, 0)
+
+    def snapshot(self, reset: bool = False) -> dict:
+        """
+        Return the current usage. With reset, the peak and wait figures start
+        over, so that the next snapshot covers only what happens after this one.
+        """
+        with self._lock:
+            stats = {
+                "max_connections": self.max_connections,
+                "in_use": self._in_use,
+                "peak_in_use": self._peak_in_use,
+                "checkouts": self._checkouts,
+                "mean_wait_ms": (
+                    1000 * self._wait_total / self._checkouts if self._checkouts else 0
+                ),
+                "max_wait_ms": 1000 * self._wait_max,
+            }
+            if reset:
+                self._peak_in_use = self._in_use
+                self._checkouts = 0
+                self._wait_total = 0.0
+                self._wait_max = 0.0
+            return stats
+
+
+class InstrumentedConnectionPool(redis.BlockingConnectionPool):
+    """
+    BlockingConnectionPool that keeps PoolStats of its usage
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats(self.max_connections)
+
+    def get_connection(self, *args, **kwargs):
+        started = time.monotonic()
+        connection = super().get_connection(*args, **kwargs)
+        self.stats.checked_out(time.monotonic() - started)
+        return connection
+
+    def release(self, connection):
+        super().release(connection)
+        self.stats.released()
+
+
+class AsyncInstrumentedConnectionPool(redis.asyncio.BlockingConnectionPool):
+    """
+    asyncio BlockingConnectionPool that keeps PoolStats of its usage
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats(self.max_connections)
+
+    async def get_connection(self, *args, **kwargs):
+        started = time.monotonic()
+        connection = await super().get_connection(*args, **kwargs)
+        self.stats.checked_out(time.monotonic() - started)
+        return connection
+
+    async def release(self, connection):
+        await super().release(connection)
+        self.stats.released()
+
+
+class InstrumentedSentinelConnectionPool(
+    redis.sentinel.SentinelConnectionPool, InstrumentedConnectionPool
+):
+    """
+    InstrumentedConnectionPool of connections to the primary that Sentinel
+    reports for a service
+    """
+
+
+class AsyncInstrumentedSentinelConnectionPool(
+    redis.asyncio.sentinel.SentinelConnectionPool, AsyncInstrumentedConnectionPool
+):
+    """
+    AsyncInstrumentedConnectionPool of connections to the primary that
+    Sentinel reports for a service
+    """
+
+
+def merge_pool_stats(snapshots: list) -> dict:
+    """
+    Combine PoolStats snapshots of several pools, such as those of the nodes
+    of a cluster
+    """
+    checkouts = sum(stats["checkouts"] for stats in snapshots)
+    merged = {
+        name: sum(stats[name] for stats in snapshots)
+        for name in ("max_connections", "in_use", "peak_in_use", "checkouts")
+    }
+    merged["mean_wait_ms"] = (
+        sum(stats["mean_wait_ms"] * stats["checkouts"] for stats in snapshots)
+        / checkouts
+        if checkouts
+        else 0
+    )
+    merged["max_wait_ms"] = max(
+        (stats["max_wait_ms"] for stats in snapshots), default=0
+    )
+    return merged
+
+
+# Helpers whose pool usage is logged, and the one thread of the process that
+# logs it. Helpers drop out of the set once they are garbage collected.
+_logged_helpers = weakref.WeakSet()
+_stats_thread = None
+_stats_lock = threading.Lock()
+
+
+def log_pool_stats(helper, interval: float):
+    """
+    Log the pool usage of a helper every interval seconds for as long as it
+    exists. All helpers of a process are logged by one thread, at the
+    interval of the first one.
+    """
+    global _stats_thread
+    with _stats_lock:
+        _logged_helpers.add(helper)
+        if _stats_thread is None:
+            _stats_thread = threading.Thread(
+                target=_log_pool_stats,
+                args=(interval,),
+                name="db-pool-stats",
+                daemon=True,
+            )
+            _stats_thread.start()
+
+
+def _log_pool_stats(interval: float):
+    while True:
+        time.sleep(interval)
+        for helper in list(_logged_helpers):
+            try:
+                logging.info(
+                    "Redis connection pool of {}: {}".format(
+                        helper.origin or "client", helper.pool_stats(reset=True)
+                    )
+                )
+            except Exception as e:
+                logging.error("Failed to read the Redis connection pool usage")
+                logging.error(e)
+
+
+def sentinel_master(config: aconfig.Config, use_asyncio: bool = False, **overrides):
+    """
+    Client of the primary that the sentinels in config report for the
+    service_name of datastore.sentinel. The sentinels are asked again when a
+    connection to the primary fails, so a failover is followed without a
+    restart. overrides replace the arguments of pool_kwargs.
+    """
+    sentinel_config = config.datastore.sentinel or {}
+    kwargs = pool_kwargs(config, use_asyncio, **overrides)
+    host, port = kwargs.pop("host"), kwargs.pop("port")
+    # Sentinels as host:port, or else the connection host and port
+    sentinels = [
+        (node.rsplit(":", 1)[0], int(node.rsplit(":", 1)[1]))
+        for node in sentinel_config.get("nodes") or []
+    ] or [(host, port)]
+    sentinel_kwargs = {
+        "socket_timeout": kwargs["socket_timeout"],
+        "socket_connect_timeout": kwargs["socket_connect_timeout"],
+        "ssl": kwargs["ssl"],
+        "ssl_ca_certs": kwargs.get("ssl_ca_certs"),
+        "password": os.environ.get("REDIS_SENTINEL_PASSWORD"),
+    }
+    if not sentinel_kwargs["ssl"]:
+        sentinel_kwargs.pop("ssl_ca_certs")
+    if use_asyncio:
+        sentinel_class = redis.asyncio.sentinel.Sentinel
+        pool_class = AsyncInstrumentedSentinelConnectionPool
+    else:
+        sentinel_class = redis.sentinel.Sentinel
+        pool_class = InstrumentedSentinelConnectionPool
+    sentinel = sentinel_class(sentinels, sentinel_kwargs=sentinel_kwargs)
+    return sentinel.master_for(
+        sentinel_config.get("service_name") or "mymaster",
+        connection_pool_class=pool_class,
+        **kwargs,
+    )
+
+
+class PartitionedKeys:
+    """
+    Key layout that spreads records over datastore.cluster.partitions
+    partitions, each a Redis Cluster hash tag. The index entries of a record
+    are in indexes of its own partition, so a write and its index updates
+    stay in one slot. Index members are training ids, as with the plain
+    layout.
+
+    The number of partitions can't change once records are stored.
+    """
+
+    def _init_partitions(self, config: aconfig.Config):
+        cluster_config = config.datastore.cluster or {}
+        self._partitions = cluster_config.get("partitions") or 64
+
+    def _partition(self, key: str) -> int:
+        return zlib.crc32(key.encode()) % self._partitions
+
+    def _partition_key(self, partition: int, name: str) -> str:
+        return "train_conductor:{" + str(partition) + "}:" + name
+
+    def _partition_index_keys(self, name: str) -> list:
+        """
+        Keys of the index called name in every partition
+        """
+        return [self._partition_key(p, name) for p in range(self._partitions)]
+
+    def _record_key(self, key: str) -> str:
+        return self._partition_key(self._partition(key), "job:" + key)
+
+    def _record_index_key(self, name: str, key: str) -> str:
+        return self._partition_key(self._partition(key), name)
 
 
 class RedisHelper(DatabaseBase):
-    def __init__(self, config: aconfig.Config):
+    # Whether change notifications are sent after the writes they are about,
+    # rather than together with them, for servers where the change stream
+    # can't be written in the same transaction as a record
+    _notify_after_write = False
+
+    def __init__(self, config: aconfig.Config, origin: str = None):
+        """
+        Connect to the Redis server in config. If an origin is given, change
+        notifications for writes made through this helper are tagged with it,
+        so that listeners can skip changes they made themselves.
+        """
         self.config = config
+        self.origin = origin
         logging.info("Attempting connection to Redis")
-        redis_config = self.config.datastore.connection
-        redis_host = redis_config.host
-        type_check("<TCD47773352E>", str, redis_host=redis_host)
-        redis_port = redis_config.port
-        type_check("<TCD47773353E>", int, redis_port=redis_port)
-        redis_db_num = redis_config.db_num
-        type_check("<TCD47773354E>", int, redis_db_num=redis_db_num)
-        user = redis_config.user or None
-        password = os.environ.get("REDIS_PASSWORD")
-        ca_cert = os.environ.get("REDIS_CA_FILE")
-        if ca_cert:
-            file_check("<TCD08017879E>", ca_cert)
-        ssl_enable = False
-        if ca_cert:
-            ssl_enable = True
-        self._client = redis.Redis(
-            host=redis_host,
-            port=redis_port,
-            db=redis_db_num,
-            decode_responses=True,
-            username=user,
-            password=password,
-            ssl_ca_certs=ca_cert,
-            ssl=ssl_enable,
-        )
+        self._client = self._connect()
+        # Pool usage is logged every stats_interval seconds, 0 to disable
+        stats_interval = self.config.datastore.connection.get("stats_interval", 300)
+        if stats_interval:
+            log_pool_stats(self, stats_interval)
+
+        # Every write appends the changed key to a stream, which listeners
+        # read either on their own or as members of a consumer group
+        feed_config = self.config.datastore.change_feed or {}
+        self._stream_key = self._index_key("changes")
+        self._stream_max_len = feed_config.get("max_len") or 100000
+        self._read_batch_size = feed_config.get("batch_size") or 100
+        self._read_block_ms = feed_config.get("block_ms") or 2000
+        self._claim_idle_ms = feed_config.get("claim_idle_ms") or 60000
+
+        # Loaded once and run by its SHA afterwards
+        self._transition_script = self._client.register_script(TRANSITION_SCRIPT)
+        self._index_script = self._client.register_script(INDEX_SCRIPT)
+        self._lease_script = self._client.register_script(LEASE_SCRIPT)
+        self._release_script = self._client.register_script(RELEASE_SCRIPT)
+        self._write_batch_size = self.config.datastore.write_batch_size or 500
+        # Number of recent job run times kept for estimating queue wait times
+        self._durations_kept = self.config.datastore.durations_kept or 100
+
+    def ping(self):
+        return self._client.ping()
+
+    def pool_stats(self, reset: bool = False) -> dict:
+        return self._client.connection_pool.stats.snapshot(reset)
+
+    def _connect(self, **overrides):
+        """
+        Return a client for the server in config. overrides replace the
+        arguments of its connection pool.
+        """
+        return redis.Redis(connection_pool=connection_pool(self.config, **overrides))
+
+    def _disconnect(self, client):
+        client.connection_pool.disconnect()
 
     def write_record(self, key: str, record: dict) -> int:
-        added_fields = self._client.hset(key, mapping=record)
-        self.publish_data(key)
-        return added_fields
+        return self.write_fields(key, record)
 
     def write_field(self, key: str, field: str, value):
-        added_fields = self._client.hset(key, field, value)
-        self.publish_data(key)
-        return added_fields
+        return self.write_fields(key, {field: value})
+
+    def write_fields(self, key: str, mapping: dict, notify: bool = True) -> int:
+        pipe = self._client.pipeline()
+        self._queue_write(pipe, key, mapping, notify)
+        result = pipe.execute()[0]
+        if notify and self._notify_after_write:
+            self._publish_many([key])
+        return result
+
+    def _queue_write(self, pipe, key: str, mapping: dict, notify: bool = True):
+        """
+        Queue a record write on a transactional pipeline, together with the
+        index updates and change notification that go with it
+        """
+        pipe.hset(self._record_key(key), mapping=mapping)
+        pipe.sadd(self._record_index_key("active", key), key)
+        status = mapping.get("status")
+        if status:
+            for other in TrainingStatus:
+                if other.name != status:
+                    pipe.srem(self._status_index_key(other, key), key)
+            pipe.sadd(self._status_index_key(status, key), key)
+        model_name = mapping.get("model_name")
+        if model_name:
+            pipe.sadd(self._record_index_key("model:" + model_name, key), key)
+        if notify and not self._notify_after_write:
+            self._publish(pipe, key)
+
+    def transition_status(
+        self,
+        key: str,
+        status,
+        expected=None,
+        fields: dict = None,
+        notify: bool = True,
+    ):
+        applied, record = self._parse_transition(
+            self._queue_transition(self._client, key, status, expected, fields, notify)
+        )
+        if applied and notify and self._notify_after_write:
+            self._publish_many([key])
+        return applied, record
+
+    def write_batch(self, writes: list[RecordWrite]) -> list:
+        results = []
+        for start in range(0, len(writes), self._write_batch_size):
+            batch = writes[start : start + self._write_batch_size]
+            pipe = self._client.pipeline()
+            # Each write queues several commands; remember where each one starts
+            offsets = []
+            for write in batch:
+                offsets.append(len(pipe))
+                if write.status:
+                    self._queue_transition(
+                        pipe,
+                        write.key,
+                        write.status,
+                        write.expected,
+                        write.fields,
+                        write.notify,
+                    )
+                else:
+                    self._queue_write(pipe, write.key, write.fields, write.notify)
+            responses = pipe.execute()
+            notified = []
+            for write, offset in zip(batch, offsets):
+                if write.status:
+                    result = self._parse_transition(responses[offset])
+                    if result[0] and write.notify:
+                        notified.append(write.key)
+                else:
+                    result = responses[offset]
+                    if write.notify:
+                        notified.append(write.key)
+                results.append(result)
+            if self._notify_after_write:
+                self._publish_many(notified)
+        return results
+
+    def _queue_transition(self, client, key, status, expected, fields, notify):
+        """
+        Run the transition script on a client or queue it on a pipeline
+        """
+        if isinstance(status, str):
+            status = getattr(TrainingStatus, status)
+        if isinstance(expected, TrainingStatus):
+            expected = expected.name
+        allowed_from = [
+            current.name
+            for current, targets in VALID_TRANSITIONS.items()
+            if status in targets
+        ]
+        args = [
+            status.name,
+            expected or "",
+            " ".join(allowed_from),
+            " ".join(s.name for s in TrainingStatus),
+            "1" if notify and not self._notify_after_write else "0",
+            self._stream_max_len,
+            self.origin or "",
+            key,
+        ]
+        for field, value in (fields or {}).items():
+            args.extend([field, value])
+        keys = [self._record_key(key), self._record_index_key("active", key)]
+        keys.extend(self._status_index_key(s, key) for s in TrainingStatus)
+        if notify and not self._notify_after_write:
+            keys.append(self._stream_key)
+        return self._transition_script(keys=keys, args=args, client=client)
+
+    @staticmethod
+    def _parse_transition(result):
+        if not result:
+            return False, {}
+        applied, flat_record = result
+        record = dict(zip(flat_record[::2], flat_record[1::2]))
+        return bool(applied), record
 
     def read_record(self, key: str) -> dict:
-        record = self._client.hgetall(key)
+        record = self._client.hgetall(self._record_key(key))
         return record
 
     def read_field(self, key: str, field: str):
-        return self._client.hget(key, field)
+        return self._client.hget(self._record_key(key), field)
 
     def has_key(self, key: str) -> bool:
-        return self._client.exists(key)
+        return self._client.exists(self._record_key(key))
 
     def iterate_entries(self, filter: str = None, cursor=None):
-        return self._client.scan(cursor=cursor, match=filter)
+        # Only records are stored as hashes, this skips the index keys
+        return self._client.scan(cursor=cursor, match=filter, _type="hash")
+
+    def iterate_active_entries(self, cursor=None):
+        return self._client.sscan(self._index_key("active"), cursor=cursor or 0)
+
+    def mark_inactive(self, *keys: str):
+        if not keys:
+            return 0
+        return self._client.srem(self._index_key("active"), *keys)
+
+    def index_entries(self, entries: dict):
+        pipe = self._client.pipeline(transaction=False)
+        status_names = " ".join(s.name for s in TrainingStatus)
+        for key, record in entries.items():
+            if not record:
+                continue
+            keys = [self._record_key(key)]
+            keys.extend(self._status_index_key(s, key) for s in TrainingStatus)
+            self._index_script(keys=keys, args=[key, status_names], client=pipe)
+            model_name = record.get("model_name")
+            if model_name:
+                pipe.sadd(self._record_index_key("model:" + model_name, key), key)
+            status = record.get("status")
+            if not status or TrainingStatus[status] not in COMPLETED_STATES:
+                pipe.sadd(self._record_index_key("active", key), key)
+        if len(pipe):
+            pipe.execute()
+
+    def list_by_status(self, status, cursor=None, count: int = None):
+        return self._client.sscan(
+            self._status_index_key(status), cursor=cursor or 0, count=count
+        )
+
+    def list_by_model(self, model_name: str, cursor=None, count: int = None):
+        return self._client.sscan(
+            self._index_key("model:" + model_name), cursor=cursor or 0, count=count
+        )
 
     def read_many_entries(self, keys: list[str]):
         pipe = self._client.pipeline()
         for key in keys:
-            pipe.hgetall(key)
+            pipe.hgetall(self._record_key(key))
         responses = pipe.execute()
 
         return dict(zip(keys, responses))
 
+    def schedule_retry(self, key: str, due_at: float):
+        self._client.zadd(self._index_key("retries"), {key: due_at})
+
+    def due_retries(self, until: float, count: int = None) -> list:
+        return self._client.zrangebyscore(
+            self._index_key("retries"),
+            "-inf",
+            until,
+            start=0 if count else None,
+            num=count,
+        )
+
+    def read_retries(self, keys: list) -> dict:
+        pipe = self._client.pipeline()
+        for key in keys:
+            pipe.zscore(self._index_key("retries"), key)
+        responses = pipe.execute()
+        return {key: due for key, due in zip(keys, responses) if due is not None}
+
+    def clear_retries(self, *keys: str):
+        if keys:
+            self._client.zrem(self._index_key("retries"), *keys)
+
+    def enqueue_admission(self, scores: dict):
+        if scores:
+            self._client.zadd(self._index_key("admission"), scores, nx=True)
+
+    def read_admission_queue(self, count: int) -> list:
+        return self._client.zrange(self._index_key("admission"), 0, count - 1)
+
+    def dequeue_admission(self, *keys: str):
+        if keys:
+            self._client.zrem(self._index_key("admission"), *keys)
+
+    def admission_positions(self, keys: list) -> dict:
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrank(self._index_key("admission"), key)
+        return dict(zip(keys, pipe.execute()))
+
+    def count_backlog(self) -> int:
+        pipe = self._client.pipeline()
+        pipe.zcard(self._index_key("admission"))
+        pipe.scard(self._status_index_key(TrainingStatus.PLACEHOLDER_UNSET))
+        return sum(pipe.execute())
+
+    def count_by_status(self, status) -> int:
+        return self._client.scard(self._status_index_key(status))
+
+    def record_durations(self, *durations: float):
+        if not durations:
+            return
+        pipe = self._client.pipeline()
+        pipe.lpush(self._index_key("durations"), *durations)
+        pipe.ltrim(self._index_key("durations"), 0, self._durations_kept - 1)
+        pipe.execute()
+
+    def read_durations(self) -> list:
+        return [
+            float(d) for d in self._client.lrange(self._index_key("durations"), 0, -1)
+        ]
+
+    def write_checkpoint(self, name: str, value: str):
+        return self._client.set(self._index_key("checkpoint:" + name), value)
+
+    def read_checkpoint(self, name: str) -> str:
+        return self._client.get(self._index_key("checkpoint:" + name))
+
+    def acquire_lease(self, name: str, holder: str, ttl_ms: int) -> bool:
+        return bool(
+            self._lease_script(
+                keys=[self._index_key("lease:" + name)], args=[holder, ttl_ms]
+            )
+        )
+
+    def release_lease(self, name: str, holder: str):
+        return self._release_script(
+            keys=[self._index_key("lease:" + name)], args=[holder]
+        )
+
+    def register_member(self, group: str, member: str, ttl_ms: int) -> list:
+        key = self._index_key("members:" + group)
+        now_ms = int(time.time() * 1000)
+        pipe = self._client.pipeline()
+        pipe.zadd(key, {member: now_ms + ttl_ms})
+        pipe.zremrangebyscore(key, "-inf", now_ms)
+        pipe.zrange(key, 0, -1)
+        return pipe.execute()[-1]
+
+    def unregister_member(self, group: str, member: str):
+        return self._client.zrem(self._index_key("members:" + group), member)
+
     def publish_data(self, key):
-        self._client.publish("train_conductor", str(key))
+        self._publish(self._client, key)
+
+    def _publish(self, client, key):
+        fields = {"key": str(key)}
+        if self.origin:
+            fields["origin"] = self.origin
+        client.xadd(
+            self._stream_key,
+            fields,
+            maxlen=self._stream_max_len,
+            approximate=True,
+        )
+
+    def _publish_many(self, keys: list):
+        """
+        Send the change notifications of writes that were made without them
+        """
+        if not keys:
+            return
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            self._publish(pipe, key)
+        pipe.execute()
+
+    @staticmethod
+    def _index_key(name: str) -> str:
+        return "train_conductor:" + name
+
+    def _record_key(self, key: str) -> str:
+        """
+        Key the record of key is stored under
+        """
+        return key
+
+    def _record_index_key(self, name: str, key: str) -> str:
+        """
+        Key of the index called name that key belongs in
+        """
+        return self._index_key(name)
+
+    def _status_index_key(self, status, key: str = None) -> str:
+        if isinstance(status, TrainingStatus):
+            status = status.name
+        return self._record_index_key("status:" + status, key)
+
+    def start_listener(
+        self,
+        db_update_event_handler,
+        group: str = None,
+        ignore_own: bool = False,
+        stop_event: threading.Event = None,
+    ):
+        """
+        Start a daemon thread that calls db_update_event_handler with the key of
+        every changed record. See listen for the meaning of the arguments.
+        """
+        thread = threading.Thread(
+            target=self.listen,
+            args=(db_update_event_handler,),
+            kwargs={
+                "group": group,
+                "ignore_own": ignore_own,
+                "stop_event": stop_event,
+            },
+            name="db-listener",
+            daemon=True,
+        )
+        thread.start()
+        return thread
+
+    def listen(
+        self,
+        db_update_event_handler,
+        group: str = None,
+        ignore_own: bool = False,
+        stop_event: threading.Event = None,
+    ):
+        """
+        Read the change stream and call db_update_event_handler with the key of
+        every changed record, until stop_event is set. Each read waits at most
+        block_ms for new entries, which bounds how long stopping takes.
+
+        Without a group, every listener sees every change made after it started.
+        With a group, each change is delivered to only one member of the group
+        and acknowledged once the handler has taken its key. Entries the group
+        has not read yet are delivered after a restart. Entries a member read
+        but did not acknowledge are read again by that member when it restarts,
+        or claimed by the others once they have been idle for claim_idle_ms.
+
+        With ignore_own, changes made through a helper with the same origin as
+        this one are skipped.
+
+        The listener has a connection of its own, so blocking reads don't hold
+        one of the pool's, and its reads may block longer than socket_timeout.
+        """
+        socket_timeout = self.config.datastore.connection.socket_timeout or 5
+        client = self._connect(
+            max_connections=1,
+            socket_timeout=self._read_block_ms / 1000 + socket_timeout,
+        )
+        if group:
+            read_batch = self._group_reader(client, group, socket.gethostname())
+        else:
+            read_batch = self._stream_reader(client)
+
+        stop_event = stop_event or threading.Event()
+        while not stop_event.is_set():
+            try:
+                entries = read_batch()
+                handled = []
+                try:
+                    for entry_id, fields in entries:
+                        # Pending entries that were trimmed from the stream have
+                        # no fields
+                        if fields and not (
+                            ignore_own and fields.get("origin") == self.origin
+                        ):
+                            db_update_event_handler(fields.get("key"))
+                        handled.append(entry_id)
+                finally:
+                    # Entries are acknowledged only once their key was handed on
+                    if group and handled:
+                        client.xack(self._stream_key, group, *handled)
+            except Exception as e:
+                logging.error("Exception in DB listener")
+                logging.error(e)
+                stop_event.wait(1)
+        self._disconnect(client)
+
+    def _stream_reader(self, client):
+        """
+        Return a function that reads the next batch of stream entries, starting
+        from the end of the stream
+        """
+        last = client.xrevrange(self._stream_key, count=1)
+        last_id = last[0][0] if last else "0-0"
+
+        def read_batch():
+            nonlocal last_id
+            response = client.xread(
+                {self._stream_key: last_id},
+                count=self._read_batch_size,
+                block=self._read_block_ms,
+            )
+            entries = response[0][1] if response else []
+            if entries:
+                last_id = entries[-1][0]
+            return entries
+
+        return read_batch
+
+    def _group_reader(self, client, group: str, consumer: str):
+        """
+        Return a function that reads the next batch of entries for a member of a
+        consumer group: first the entries it left pending before a restart, then
+        entries of members idle for too long, then new entries. Entries of idle
+        members are claimed on startup and every claim_idle_ms afterwards.
+        """
+        try:
+            # A new group starts at the end of the stream, records written
+            # before it existed are picked up by the watcher's startup reconcile
+            client.xgroup_create(self._stream_key, group, id="$", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+
+        recovering = True
+        # Where a pass of XAUTOCLAIM over the pending entries of the group
+        # continues, "0-0" when no pass is under way
+        claim_from = "0-0"
+        last_claim = 0
+
+        def read_group(stream_id, block=None):
+            response = client.xreadgroup(
+                group,
+                consumer,
+                {self._stream_key: stream_id},
+                count=self._read_batch_size,
+                block=block,
+            )
+            return response[0][1] if response else []
+
+        def read_batch():
+            nonlocal recovering, claim_from, last_claim
+            if recovering:
+                entries = read_group("0")
+                if entries:
+                    return entries
+                recovering = False
+
+            if (
+                claim_from != "0-0"
+                or time.monotonic() - last_claim >= self._claim_idle_ms / 1000
+            ):
+                last_claim = time.monotonic()
+                claimed = client.xautoclaim(
+                    self._stream_key,
+                    group,
+                    consumer,
+                    min_idle_time=self._claim_idle_ms,
+                    start_id=claim_from,
+                    count=self._read_batch_size,
+                )
+                claim_from = claimed[0]
+                if claimed[1]:
+                    return claimed[1]
+
+            return read_group(">", block=self._read_block_ms)
+
+        return read_batch
+
+
+class RedisClusterHelper(PartitionedKeys, RedisHelper):
+    """
+    RedisHelper for a Redis Cluster, found through the node at the connection
+    host and port. Records and their indexes are spread over the cluster by
+    the PartitionedKeys layout. Full scans run on every primary at once, and
+    indexes are read a partition at a time.
+
+    The change stream and the other shared keys have slots of their own, so
+    change notifications are sent once the writes they are about are done,
+    rather than in the same transaction. The commands of a write go to one
+    node in a pipeline without MULTI, so a failover in the middle of one may
+    leave it partly applied. Full reconciles scan records rather than
+    indexes, so they still find a record missing from the active index.
+    """
+
+    _notify_after_write = True
+
+    def __init__(self, config: aconfig.Config, origin: str = None):
+        self._init_partitions(config)
+        super().__init__(config, origin)
+        # Scripts queued on a pipeline that spans nodes can't be loaded on
+        # demand, so they are sent whole
+        self._transition_script = self._eval_script(TRANSITION_SCRIPT)
+        self._index_script = self._eval_script(INDEX_SCRIPT)
+        self._lease_script = self._eval_script(LEASE_SCRIPT)
+        self._release_script = self._eval_script(RELEASE_SCRIPT)
+        self._scan_executor = ThreadPoolExecutor(thread_name_prefix="db-scan")
+
+    def _connect(self, **overrides):
+        kwargs = pool_kwargs(self.config, **overrides)
+        url = "{}://{}:{}".format(
+            "rediss" if kwargs.pop("ssl") else "redis",
+            kwargs.pop("host"),
+            kwargs.pop("port"),
+        )
+        # A cluster only has database 0
+        kwargs.pop("db")
+        # Node pools are only built with connection_pool_class when the
+        # cluster is given as a url. The cluster client drops the health check
+        # interval from the arguments it passes them, so it is bound here.
+        pool_class = functools.partial(
+            InstrumentedConnectionPool,
+            health_check_interval=kwargs.pop("health_check_interval"),
+        )
+        return redis.cluster.RedisCluster(
+            url=url, connection_pool_class=pool_class, **kwargs
+        )
+
+    def _disconnect(self, client):
+        client.close()
+
+    def pool_stats(self, reset: bool = False) -> dict:
+        return merge_pool_stats(
+            [
+                node.redis_connection.connection_pool.stats.snapshot(reset)
+                for node in self._client.get_nodes()
+                if node.redis_connection
+            ]
+        )
 
-    def start_listener(self, db_update_event_handler):
-        pubsub = self._client.pubsub()
-        pubsub.psubscribe(**{"train_conductor": db_update_event_handler})
+    def _eval_script(self, script: str):
+        def run(keys, args, client=None):
+            return (client or self._client).eval(script, len(keys), *keys, *args)
 
-        def exception_handler(ex, pubsub, thread):
-            logging.error(ex)
-            thread.stop()
-            thread.join(timeout=1.0)
-            pubsub.close()
+        return run
 
-        thread = pubsub.run_in_thread(
-            sleep_time=0.01, exception_handler=exception_handler
+    def iterate_entries(self, filter: str = None, cursor=None):
+        """
+        SCAN every primary at once. The cursor packs the SCAN cursors of the
+        primaries, in the order of their names, 64 bits each. A scan that
+        spans a change of primaries may miss records.
+        """
+        primaries = sorted(self._client.get_primaries(), key=lambda node: node.name)
+        cursor = int(cursor or 0)
+        if cursor:
+            cursors = [
+                (cursor >> (64 * i)) & (2**64 - 1) for i in range(len(primaries))
+            ]
+            # Primaries whose scan is done have a cursor of 0
+            pending = [i for i, node_cursor in enumerate(cursors) if node_cursor]
+        else:
+            cursors = [0] * len(primaries)
+            pending = list(range(len(primaries)))
+        match = self._partition_key("*", "job:" + (filter or "*"))
+
+        def scan(i):
+            node = self._client.get_redis_connection(primaries[i])
+            return node.scan(cursor=cursors[i], match=match, _type="hash")
+
+        keys = []
+        for i, (node_cursor, node_keys) in zip(
+            pending, self._scan_executor.map(scan, pending)
+        ):
+            cursors[i] = node_cursor
+            keys.extend(key.partition(":job:")[2] for key in node_keys)
+        return sum(c << (64 * i) for i, c in enumerate(cursors)), keys
+
+    def iterate_active_entries(self, cursor=None):
+        return self._scan_partitions("active", cursor)
+
+    def mark_inactive(self, *keys: str):
+        if not keys:
+            return 0
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.srem(self._record_index_key("active", key), key)
+        return sum(pipe.execute())
+
+    def list_by_status(self, status, cursor=None, count: int = None):
+        if isinstance(status, TrainingStatus):
+            status = status.name
+        return self._scan_partitions("status:" + status, cursor, count)
+
+    def list_by_model(self, model_name: str, cursor=None, count: int = None):
+        return self._scan_partitions("model:" + model_name, cursor, count)
+
+    def _scan_partitions(self, name: str, cursor=None, count: int = None):
+        """
+        SSCAN the index called name in each partition in turn. The cursor packs
+        the partition and the SSCAN cursor within it, and is 0 once done.
+        """
+        cursor = int(cursor or 0)
+        partition = cursor % self._partitions
+        set_cursor, keys = self._client.sscan(
+            self._partition_key(partition, name),
+            cursor=cursor // self._partitions,
+            count=count,
         )
+        if not set_cursor:
+            partition += 1
+            if partition == self._partitions:
+                return 0, keys
+        return set_cursor * self._partitions + partition, keys
+
+    def count_backlog(self) -> int:
+        pipe = self._client.pipeline(transaction=False)
+        pipe.zcard(self._index_key("admission"))
+        for key in self._partition_index_keys(
+            "status:" + TrainingStatus.PLACEHOLDER_UNSET.name
+        ):
+            pipe.scard(key)
+        return sum(pipe.execute())
+
+    def count_by_status(self, status) -> int:
+        if isinstance(status, TrainingStatus):
+            status = status.name
+        pipe = self._client.pipeline(transaction=False)
+        for key in self._partition_index_keys("status:" + status):
+            pipe.scard(key)
+        return sum(pipe.execute())
+
+
+class RedisSentinelHelper(RedisHelper):
+    """
+    RedisHelper for a primary monitored by Redis Sentinel, see sentinel_master
+    """
+
+    def _connect(self, **overrides):
+        return sentinel_master(self.config, **overrides)
+
+
+class AsyncRedisHelper:
+    """
+    Reads records for code running on an asyncio event loop, such as the
+    asyncio gRPC server. Only the reads that serve training status requests
+    are covered, everything else goes through RedisHelper.
+    """
+
+    def __init__(self, config: aconfig.Config):
+        self.config = config
+        self._client = self._connect()
+
+    def _connect(self):
+        return redis.asyncio.Redis(
+            connection_pool=connection_pool(self.config, use_asyncio=True)
+        )
+
+    def _record_key(self, key: str) -> str:
+        return key
+
+    async def read_record(self, key: str) -> dict:
+        return await self._client.hgetall(self._record_key(key))
+
+    async def read_many_entries(self, keys: list[str]) -> dict:
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(self._record_key(key))
+        return dict(zip(keys, await pipe.execute()))
+
+    async def admission_positions(self, keys: list) -> dict:
+        pipe = self._client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrank(RedisHelper._index_key("admission"), key)
+        return dict(zip(keys, await pipe.execute()))
+
+    def pool_stats(self, reset: bool = False) -> dict:
+        return self._client.connection_pool.stats.snapshot(reset)
+
+    async def close(self):
+        await self._client.aclose()
+        await self._client.connection_pool.disconnect()
+
+
+class AsyncRedisClusterHelper(PartitionedKeys, AsyncRedisHelper):
+    """
+    AsyncRedisHelper for a Redis Cluster, with the keys of RedisClusterHelper
+    """
+
+    def __init__(self, config: aconfig.Config):
+        self._init_partitions(config)
+        super().__init__(config)
+
+    def _connect(self):
+        kwargs = pool_kwargs(self.config, use_asyncio=True)
+        # A cluster only has database 0, and its nodes don't wait for a
+        # free connection
+        kwargs.pop("db")
+        kwargs.pop("timeout")
+        return redis.asyncio.cluster.RedisCluster(**kwargs)
+
+    def pool_stats(self, reset: bool = False) -> dict:
+        # Nodes of the asyncio cluster client hold their connections without
+        # a pool to instrument
+        return {}
+
+    async def close(self):
+        await self._client.aclose()
+
+
+class AsyncRedisSentinelHelper(AsyncRedisHelper):
+    """
+    AsyncRedisHelper for a primary monitored by Redis Sentinel
+    """
+
+    def _connect(self):
+        return sentinel_master(self.config, use_asyncio=True)
@@ -13,12 +13,18 @@
 # limitations under the License.
 
 # Standard
+import asyncio
 import logging
-import sys
+import signal
 import os
 from concurrent import futures
+import threading
+import time
 import urllib3
 
+# Start of the startup time report, before the heavier imports below
+_IMPORT_STARTED = time.monotonic()
+
 
 # First Party
 from aconfig import Config
@@ -30,46 +36,191 @@ from grpc_reflection.v1alpha import reflection
 # Local
 from train_conductor.protobuf import trainconductor_pb2, trainconductor_pb2_grpc
 from train_conductor.training_servicer import TrainingServicer
-from train_conductor.modules.watcher import Watcher
 from train_conductor.utils import error_check
+from train_conductor.utils.helpers import configure_logging, runtime_config_file
+from train_conductor.utils.startup import StartupTimer
+
+# Transport settings of server.grpc in the runtime config, by gRPC channel argument
+GRPC_OPTIONS = {
+    "grpc.max_concurrent_streams": "max_concurrent_streams",
+    "grpc.keepalive_time_ms": "keepalive_time_ms",
+    "grpc.keepalive_timeout_ms": "keepalive_timeout_ms",
+    "grpc.keepalive_permit_without_calls": "keepalive_permit_without_calls",
+    "grpc.http2.min_ping_interval_without_data_ms": "min_ping_interval_ms",
+    "grpc.max_receive_message_length": "max_receive_message_length",
+    "grpc.max_send_message_length": "max_send_message_length",
+}
+
+COMPRESSION = {
+    "none": grpc.Compression.NoCompression,
+    "deflate": grpc.Compression.Deflate,
+    "gzip": grpc.Compression.Gzip,
+}
 
 
 class TrainingGRPCServer:
-    def __init__(self, config_path: str):
+    def __init__(
+        self,
+        config_path: str,
+        serve_grpc: bool = None,
+        run_watcher: bool = None,
+        reuse_port: bool = False,
+        timer: StartupTimer = None,
+    ):
+        """
+        Start the gRPC server unless serve_grpc is False, and the watcher unless
+        run_watcher is False. When not given, they are started unless the
+        DISABLE_GRPC or DISABLE_WATCHER environment variable is set. With
+        reuse_port, several processes can serve the same port. The phases of
+        startup are marked on timer.
+
+        The watcher, and with it the Kubernetes client, is only imported when
+        it runs.
+        """
+        timer = timer or StartupTimer()
+        if serve_grpc is None:
+            serve_grpc = not os.environ.get("DISABLE_GRPC")
+        if run_watcher is None:
+            run_watcher = not os.environ.get("DISABLE_WATCHER")
         self.config = Config.from_yaml(config_path)
+        timer.mark("config")
+        self._reuse_port = reuse_port
+        self.server = None
+        self.servicer = None
+        self.watcher = None
+        # Event loop of the asyncio server, run in its own thread
+        self._loop = None
 
-        if not os.environ.get("DISABLE_GRPC"):
-            # Start tracking service names for reflection
-            service_names = [reflection.SERVICE_NAME]
+        if serve_grpc:
+            grpc_config = (self.config.server or {}).get("grpc") or {}
+            if grpc_config.get("mode") == "aio":
+                self._loop = asyncio.new_event_loop()
+                threading.Thread(
+                    target=self._loop.run_forever, name="grpc-aio", daemon=True
+                ).start()
+                self._run(self._start_aio_server(grpc_config, timer))
+            else:
+                self.server = grpc.server(
+                    futures.ThreadPoolExecutor(
+                        max_workers=grpc_config.get("max_workers") or 10
+                    ),
+                    **self._server_kwargs(grpc_config),
+                )
+                self.servicer = TrainingServicer(self.config)
+                self.servicer.db_client.ping()
+                timer.mark("datastore")
+                self._add_services()
+                self.server.start()
+                timer.mark("grpc")
 
-            self.server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+        if run_watcher:
+            # Local
+            from train_conductor.modules.watcher import Watcher
 
-            trainconductor_pb2_grpc.add_TrainConductorServicer_to_server(
-                TrainingServicer(self.config), self.server
-            )
-            service_names.append(
-                trainconductor_pb2.DESCRIPTOR.services_by_name[
-                    "TrainConductor"
-                ].full_name
-            )
+            self.watcher = Watcher(self.config)
+            self.watcher.start()
+            timer.mark("watcher")
 
-            # Finally enable service reflection after all services are added
-            reflection.enable_server_reflection(service_names, self.server)
+    async def _start_aio_server(self, grpc_config, timer: StartupTimer):
+        # Local
+        from train_conductor.async_training_servicer import AsyncTrainingServicer
 
-            if self.config.trainer_config.mtls and self.config.trainer_config.mtls.enabled:
-                server_credentials = self.generate_server_credentials(self.config.trainer_config.mtls)
-                self.server.add_secure_port('[::]:50051', server_credentials)
-                logging.info("Starting grpc server on secure port 50051")
-            else:
-                self.server.add_insecure_port("[::]:8085")
-                logging.info("Starting grpc server on port 8085")
+        # Methods of the servicer that aren't coroutines run on this pool
+        self.server = grpc.aio.server(
+            migration_thread_pool=futures.ThreadPoolExecutor(
+                max_workers=grpc_config.get("max_workers") or 10
+            ),
+            **self._server_kwargs(grpc_config),
+        )
+        self.servicer = AsyncTrainingServicer(self.config)
+        self.servicer.db_client.ping()
+        timer.mark("datastore")
+        self._add_services()
+        await self.server.start()
+        timer.mark("grpc")
+
+    def _server_kwargs(self, grpc_config) -> dict:
+        options = []
+        for option, name in GRPC_OPTIONS.items():
+            value = grpc_config.get(name)
+            if value is not None:
+                options.append((option, int(value)))
+        if self._reuse_port:
+            options.append(("grpc.so_reuseport", 1))
+        compression = grpc_config.get("compression") or "none"
+        error_check.value_check(
+            "<TCD74240297E>",
+            compression in COMPRESSION,
+            "compression has to be one of {}",
+            ", ".join(COMPRESSION),
+        )
+        return {
+            "options": options,
+            "maximum_concurrent_rpcs": grpc_config.get("max_concurrent_rpcs") or None,
+            "compression": COMPRESSION[compression],
+        }
 
-            self.server.start()
+    def _add_services(self):
+        # Start tracking service names for reflection
+        service_names = [reflection.SERVICE_NAME]
 
-        if not os.environ.get("DISABLE_WATCHER"):
-            Watcher(self.config)
-        self.server.wait_for_termination()
+        trainconductor_pb2_grpc.add_TrainConductorServicer_to_server(
+            self.servicer, self.server
+        )
+        service_names.append(
+            trainconductor_pb2.DESCRIPTOR.services_by_name["TrainConductor"].full_name
+        )
 
+        # Finally enable service reflection after all services are added
+        reflection.enable_server_reflection(service_names, self.server)
+
+        if self.config.trainer_config.mtls and self.config.trainer_config.mtls.enabled:
+            server_credentials = self.generate_server_credentials(
+                self.config.trainer_config.mtls
+            )
+            self.server.add_secure_port("[::]:50051", server_credentials)
+            logging.info("Starting grpc server on secure port 50051")
+        else:
+            self.server.add_insecure_port("[::]:8085")
+            logging.info("Starting grpc server on port 8085")
+
+    def _run(self, coro):
+        """
+        Run a coroutine on the event loop of the asyncio server and wait for
+        its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    def wait_for_termination(self):
+        if self._loop:
+            self._run(self.server.wait_for_termination())
+            self._run(self.servicer.close())
+            self._loop.call_soon_threadsafe(self._loop.stop)
+        elif self.server:
+            self.server.wait_for_termination()
+        elif self.watcher:
+            self.watcher.wait()
+
+    def stop(self, grace: float = None):
+        """
+        Stop accepting requests, let in-flight ones finish within grace seconds,
+        and stop the watcher once its in-flight reconciles are done
+        """
+        if self._loop:
+            stopped = asyncio.run_coroutine_threadsafe(
+                self.server.stop(grace), self._loop
+            )
+            self.servicer.stop()
+        elif self.server:
+            stopped = self.server.stop(grace)
+            # Watch streams only end when their jobs finish otherwise
+            self.servicer.stop()
+        if self.watcher:
+            self.watcher.stop()
+        if self._loop:
+            stopped.result()
+        elif self.server:
+            stopped.wait()
 
     def generate_server_credentials(self, mtls_config):
         error_check.file_check(mtls_config.server_cert)
@@ -89,28 +240,33 @@ class TrainingGRPCServer:
         server_credentials = grpc.ssl_server_credentials(
             [(server_private_key, server_certificate)],
             root_certificates=ca_certificate,
-            require_client_auth=True  # This enables mTLS
+            require_client_auth=True,  # This enables mTLS
         )
 
         return server_credentials
 
 
-if __name__ == "__main__":
-    config_file = "runtime_config.yml"
-    if os.environ.get("RUNTIME_CONFIG_FILE"):
-        config_file = os.environ.get("RUNTIME_CONFIG_FILE")
-    error_check.file_check("<TCD74240296E>", config_file)
-
-    root = logging.getLogger()
-    root.setLevel(logging.INFO)
-
-    handler = logging.StreamHandler(sys.stdout)
-    handler.setLevel(logging.INFO)
-    formatter = logging.Formatter(
-        "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-    )
-    handler.setFormatter(formatter)
-    root.addHandler(handler)
+def serve(config_file: str, **kwargs):
+    """
+    Run a TrainingGRPCServer with the given arguments until SIGTERM or SIGINT
+    """
+    timer = StartupTimer(_IMPORT_STARTED)
+    timer.mark("import")
     # TODO: Hack to supress certificate check warnings. Needs fixing.
     urllib3.disable_warnings()
-    TrainingGRPCServer(config_file)
+    server = TrainingGRPCServer(config_file, timer=timer, **kwargs)
+    timer.report()
+    grace = server.config.trainer_config.shutdown_timeout or 30
+    signal.signal(signal.SIGTERM, lambda *_: server.stop(grace))
+    signal.signal(signal.SIGINT, lambda *_: server.stop(grace))
+    server.wait_for_termination()
+
+
+def main():
+    config_file = runtime_config_file()
+    configure_logging()
+    serve(config_file)
+
+
+if __name__ == "__main__":
+    main()
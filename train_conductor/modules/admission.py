@@ -0,0 +1,240 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from datetime import datetime, timezone
+import json
+import logging
+import threading
+import time
+
+# Local
+from train_conductor.datastore.database_base import DatabaseBase, RecordWrite
+from train_conductor.modules.coordination import Coordinator
+from train_conductor.modules.job_cache import JobCache
+from train_conductor.types import TrainingStatus, COMPLETED_STATES, MAX_PRIORITY
+from train_conductor.utils import error_check as error
+
+# Tenant of jobs submitted without one
+DEFAULT_TENANT = "default"
+
+
+class AdmissionController:
+    """
+    Holds jobs back from Kubernetes until there are enough free GPUs for them.
+
+    Jobs waiting for admission are kept in a queue in the datastore, ordered by
+    priority and then by submission time. Each pass admits jobs from the front
+    of the queue as long as their GPUs fit in the namespace quota. A job that
+    does not fit the namespace quota holds up the jobs behind it, so that large
+    jobs are not starved. A job that only exceeds its tenant's quota is skipped
+    and the jobs of other tenants behind it can still go.
+
+    GPUs in use are counted from the gpus label of the unfinished jobs in the
+    job cache, plus jobs admitted by this replica that are not in the cache
+    yet. A quota of 0 means no limit.
+
+    Those reservations are only known to the replica that made them, so one
+    replica has to admit all jobs: admission is not available in the shard
+    coordination mode, where every replica admits its own share of the jobs.
+    """
+
+    def __init__(
+        self,
+        db_client: DatabaseBase,
+        job_cache: JobCache,
+        coordinator: Coordinator,
+        default_gpus: int = 1,
+        namespace_gpus: int = 0,
+        tenant_gpus: dict = None,
+        default_tenant_gpus: int = 0,
+        scan_depth: int = 100,
+        reservation_ttl: float = 600,
+    ):
+        error.value_check(
+            "<TCD39507126E>",
+            coordinator.mode != "shard",
+            "admission can't be used with the shard coordination mode",
+        )
+        self.db_client = db_client
+        self.job_cache = job_cache
+        self.coordinator = coordinator
+        self.default_gpus = default_gpus
+        self.namespace_gpus = namespace_gpus
+        self.tenant_gpus = dict(tenant_gpus or {})
+        self.default_tenant_gpus = default_tenant_gpus
+        self.scan_depth = scan_depth
+        self.reservation_ttl = reservation_ttl
+
+        # Admitted jobs not seen in the job cache yet, by job_id, as
+        # (gpus, tenant, admitted at)
+        self._reservations = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+
+    def is_admitted(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._reservations
+
+    def release(self, job_id: str):
+        """
+        Give up the GPUs reserved for a job that will not be created
+        """
+        with self._lock:
+            self._reservations.pop(job_id, None)
+
+    def wake(self):
+        """
+        Run an admission pass soon, e.g. because GPUs were freed
+        """
+        self._wake.set()
+
+    def run(self, stop_event: threading.Event, interval: float, on_admit):
+        """
+        Run admission passes every interval seconds, or sooner when woken, until
+        stop_event is set. on_admit is called with the ID of every admitted job.
+        """
+        while not stop_event.is_set():
+            self._wake.wait(interval)
+            self._wake.clear()
+            if stop_event.is_set():
+                return
+            for job_id in self.admit():
+                on_admit(job_id)
+
+    def admit(self) -> list:
+        """
+        Admit as many jobs from the front of the queue as the quotas allow.
+        Returns the IDs of the admitted jobs.
+        """
+        if not self.job_cache.synced:
+            # Jobs missing from the cache would look like free GPUs
+            return []
+
+        # Only the quota bookkeeping is done under the lock, not the datastore I/O
+        keys = self.db_client.read_admission_queue(self.scan_depth)
+        entries = self.db_client.read_many_entries(keys)
+
+        admitted = []
+        done = []
+        rejected = []
+        with self._lock:
+            namespace_used, tenant_used = self._usage()
+            for job_id in keys:
+                if not self.coordinator.owns(job_id):
+                    continue
+                db_entry = entries.get(job_id)
+                status = (db_entry or {}).get("status")
+                if (
+                    not db_entry
+                    or (status and TrainingStatus[status] in COMPLETED_STATES)
+                    or job_id in self._reservations
+                ):
+                    done.append(job_id)
+                    continue
+
+                gpus = requested_gpus(db_entry, self.default_gpus)
+                tenant = db_entry.get("tenant") or DEFAULT_TENANT
+                namespace_limit = self.namespace_gpus
+                tenant_limit = self.tenant_gpus.get(tenant, self.default_tenant_gpus)
+                if (namespace_limit and gpus > namespace_limit) or (
+                    tenant_limit and gpus > tenant_limit
+                ):
+                    reason = "Job requests {} GPUs, more than its quota allows".format(
+                        gpus
+                    )
+                    rejected.append(
+                        RecordWrite(
+                            job_id,
+                            {
+                                "errors": reason,
+                                "completion_timestamp": datetime.now(
+                                    timezone.utc
+                                ).strftime("%m/%d/%Y %H:%M:%S"),
+                            },
+                            status=TrainingStatus.FAILED,
+                        )
+                    )
+                    done.append(job_id)
+                    continue
+                if namespace_limit and namespace_used + gpus > namespace_limit:
+                    break
+                if tenant_limit and tenant_used.get(tenant, 0) + gpus > tenant_limit:
+                    continue
+
+                namespace_used += gpus
+                tenant_used[tenant] = tenant_used.get(tenant, 0) + gpus
+                self._reservations[job_id] = (gpus, tenant, time.monotonic())
+                admitted.append(job_id)
+                done.append(job_id)
+
+        if rejected:
+            self.db_client.write_batch(rejected)
+        self.db_client.dequeue_admission(*done)
+
+        if admitted:
+            logging.info(
+                "Admitted {} jobs, {} GPUs in use".format(len(admitted), namespace_used)
+            )
+        return admitted
+
+    def _usage(self):
+        """
+        Count the GPUs of unfinished jobs in the job cache and of reservations,
+        dropping reservations that are in the cache now or expired. Call with
+        the lock held.
+        """
+        namespace_used = 0
+        tenant_used = {}
+        jobs = self.job_cache.snapshot()
+        for job in jobs.values():
+            status = job.status
+            if status and (status.succeeded or status.failed):
+                continue
+            labels = job.metadata.labels or {}
+            gpus = int(labels.get("gpus") or self.default_gpus)
+            tenant = labels.get("tenant") or DEFAULT_TENANT
+            namespace_used += gpus
+            tenant_used[tenant] = tenant_used.get(tenant, 0) + gpus
+
+        now = time.monotonic()
+        for job_id, (gpus, tenant, admitted_at) in list(self._reservations.items()):
+            if job_id in jobs or now - admitted_at > self.reservation_ttl:
+                del self._reservations[job_id]
+                continue
+            namespace_used += gpus
+            tenant_used[tenant] = tenant_used.get(tenant, 0) + gpus
+        return namespace_used, tenant_used
+
+
+def requested_gpus(db_entry: dict, default_gpus: int) -> int:
+    """
+    Number of GPUs the job of a database record asks for
+    """
+    try:
+        params = json.loads(db_entry.get("parameters") or "{}")
+    except ValueError:
+        params = {}
+    return int(params.get("num_gpus") or default_gpus)
+
+
+def admission_score(db_entry: dict) -> float:
+    """
+    Position of a job in the admission queue: higher priorities first, then
+    earlier submissions. Priorities are bounded by MAX_PRIORITY so that the
+    score stays within the integers a double represents exactly.
+    """
+    priority = max(-MAX_PRIORITY, min(MAX_PRIORITY, int(db_entry.get("priority") or 0)))
+    created_ms = int(float(db_entry.get("created_at") or time.time()) * 1000)
+    return -priority * 10**13 + created_ms
@@ -0,0 +1,185 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+import asyncio
+import logging
+import threading
+
+# Local
+from train_conductor.modules.rate_limiter import PriorityRateLimiter
+from train_conductor.utils import error_check as error
+
+try:
+    # Third Party
+    from kubernetes_asyncio import client as async_client
+    from kubernetes_asyncio import config as async_config
+except ImportError:
+    async_client = None
+    async_config = None
+
+
+class AsyncKubernetesExecutor:
+    """
+    Runs Kubernetes calls on an asyncio event loop in a background thread, so
+    that many of them can be in flight at once over a pool of keep-alive
+    connections. Each kind of call has its own limit on how many run at once,
+    and all calls go through the rate limiter, if one is given.
+
+    Requires the optional kubernetes_asyncio package.
+    """
+
+    def __init__(
+        self,
+        namespace: str,
+        create_concurrency: int = 32,
+        delete_concurrency: int = 32,
+        log_concurrency: int = 8,
+        connection_pool_size: int = 64,
+        limiter: PriorityRateLimiter = None,
+    ):
+        error.value_check(
+            "<TCD40871236E>",
+            async_client is not None,
+            "the async engine requires the kubernetes_asyncio package",
+        )
+        self.namespace = namespace
+        self.connection_pool_size = connection_pool_size
+        self.limiter = limiter
+        self._limits = {
+            "create": create_concurrency,
+            "delete": delete_concurrency,
+            "logs": log_concurrency,
+        }
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        """
+        Start the event loop thread and connect to the API server
+        """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="k8s-executor", daemon=True
+        )
+        self._thread.start()
+        self.run(self._connect())
+
+    def stop(self):
+        if not self._loop:
+            return
+        try:
+            self.run(self._api_client.close())
+        except Exception as e:
+            logging.error("Failed to close the Kubernetes client")
+            logging.error(e)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+        self._loop = None
+
+    def run(self, coro):
+        """
+        Run a coroutine on the event loop and wait for its result
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+
+    async def create_job(self, body: dict):
+        """
+        Create a job. If a job of the same name exists already, e.g. created
+        by an earlier attempt whose outcome was not recorded, that job is
+        returned instead.
+        """
+        async with self._semaphores["create"]:
+            try:
+                return await self._call(
+                    "create",
+                    self._batch_v1_api.create_namespaced_job,
+                    namespace=self.namespace,
+                    body=body,
+                )
+            except async_client.exceptions.ApiException as e:
+                if e.status != 409:
+                    raise
+        return await self._call(
+            "read",
+            self._batch_v1_api.read_namespaced_job,
+            name=body["metadata"]["name"],
+            namespace=self.namespace,
+        )
+
+    async def delete_job(self, name: str, namespace: str = None):
+        async with self._semaphores["delete"]:
+            # Pods of the job are deleted in the background
+            await self._call(
+                "delete",
+                self._batch_v1_api.delete_namespaced_job,
+                name=name,
+                namespace=namespace or self.namespace,
+                propagation_policy="Background",
+            )
+
+    async def get_job_logs(self, job_name: str) -> str:
+        """
+        Fetch the logs of all pods of a job at once, skipping pods whose logs
+        can't be read
+        """
+        async with self._semaphores["logs"]:
+            pods = await self._call(
+                "read",
+                self._core_v1_api.list_namespaced_pod,
+                namespace=self.namespace,
+                label_selector="job-name=" + job_name,
+            )
+        logs = await asyncio.gather(
+            *[self._read_pod_log(pod.metadata.name) for pod in pods.items]
+        )
+        return "".join(logs)
+
+    async def _read_pod_log(self, pod_name: str) -> str:
+        async with self._semaphores["logs"]:
+            try:
+                return await self._call(
+                    "logs",
+                    self._core_v1_api.read_namespaced_pod_log,
+                    pod_name,
+                    self.namespace,
+                )
+            except Exception:
+                logging.debug("Could not retreive logs for pod " + pod_name)
+                return ""
+
+    async def _call(self, lane: str, func, *args, **kwargs):
+        if self.limiter:
+            return await self.limiter.call_async(lane, func, *args, **kwargs)
+        return await func(*args, **kwargs)
+
+    async def _connect(self):
+        configuration = async_client.Configuration()
+        try:
+            async_config.load_incluster_config(client_configuration=configuration)
+        except async_config.ConfigException:
+            # Fallback for local development
+            await async_config.load_kube_config(client_configuration=configuration)
+        # Same as the synchronous client, see Watcher
+        configuration.verify_ssl = False
+        configuration.connection_pool_maxsize = self.connection_pool_size
+
+        self._api_client = async_client.ApiClient(configuration)
+        self._batch_v1_api = async_client.BatchV1Api(self._api_client)
+        self._core_v1_api = async_client.CoreV1Api(self._api_client)
+        # Created here to belong to the executor's event loop
+        self._semaphores = {
+            name: asyncio.Semaphore(limit) for name, limit in self._limits.items()
+        }
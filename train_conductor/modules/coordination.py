@@ -0,0 +1,193 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from bisect import bisect
+import hashlib
+import logging
+import threading
+import time
+
+# Local
+from train_conductor.datastore.database_base import DatabaseBase
+from train_conductor.utils import error_check as error
+
+# Name of the lease, and of the member group, shared by the watcher replicas
+COORDINATION_NAME = "watcher"
+
+COORDINATION_MODES = ["none", "leader", "shard"]
+
+
+class Coordinator:
+    """
+    Decides which jobs this watcher replica reconciles, in one of three modes:
+
+    none: every job; use with a single replica.
+    leader: replicas compete for a lease in the datastore and only the holder
+        reconciles. The others keep their job cache warm to take over quickly.
+    shard: replicas register as members of a group in the datastore and jobs
+        are split between the live members by consistent hashing of the
+        job_id, so only a small share of jobs moves when a member joins or
+        leaves.
+
+    on_change is called whenever this replica may have gained jobs, i.e. when
+    it becomes leader or the membership changes. It runs in run_change_handler,
+    apart from the renewals, so that a slow on_change can't let the lease or
+    registration expire.
+    """
+
+    def __init__(
+        self,
+        db_client: DatabaseBase,
+        member_id: str,
+        mode: str = "none",
+        lease_ttl: float = 15,
+        virtual_nodes: int = 64,
+        on_change=None,
+    ):
+        error.value_check(
+            "<TCD60118243E>",
+            mode in COORDINATION_MODES,
+            "coordination mode has to be one of {}",
+            COORDINATION_MODES,
+        )
+        self.db_client = db_client
+        self.member_id = member_id
+        self.mode = mode
+        self.lease_ttl = lease_ttl
+        self.virtual_nodes = virtual_nodes
+        self.on_change = on_change
+
+        self._members = []
+        self._ring = []
+        self._ring_owners = []
+        self._is_leader = False
+        # Ownership is only trusted until the lease or registration expires
+        self._valid_until = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        # Set when on_change is due
+        self._changed = threading.Event()
+
+    def owns(self, job_id: str) -> bool:
+        if self.mode == "none":
+            return True
+        with self._lock:
+            if time.monotonic() >= self._valid_until:
+                return False
+            if self.mode == "leader":
+                return self._is_leader
+            if not self._ring:
+                return False
+            index = bisect(self._ring, self._hash(job_id)) % len(self._ring)
+            return self._ring_owners[index] == self.member_id
+
+    def run(self):
+        """
+        Renew the lease or registration every third of its time to live, until stopped
+        """
+        if self.mode == "none":
+            return
+        while not self._stop.is_set():
+            try:
+                self.renew()
+            except Exception as e:
+                logging.error("Failed to renew watcher coordination")
+                logging.error(e)
+            self._stop.wait(self.lease_ttl / 3)
+
+    def run_change_handler(self):
+        """
+        Call on_change each time this replica may have gained jobs, until
+        stopped. Changes that happen while on_change runs are handled by one
+        more call.
+        """
+        if self.mode == "none" or not self.on_change:
+            return
+        while True:
+            self._changed.wait()
+            if self._stop.is_set():
+                return
+            self._changed.clear()
+            try:
+                self.on_change()
+            except Exception as e:
+                logging.error("Failed to handle a watcher coordination change")
+                logging.error(e)
+
+    def start(self) -> threading.Thread:
+        threading.Thread(
+            target=self.run_change_handler, name="coordination-changes", daemon=True
+        ).start()
+        thread = threading.Thread(target=self.run, name="coordinator", daemon=True)
+        thread.start()
+        return thread
+
+    def renew(self):
+        ttl_ms = int(self.lease_ttl * 1000)
+        renewed_at = time.monotonic()
+        changed = False
+        if self.mode == "leader":
+            is_leader = self.db_client.acquire_lease(
+                COORDINATION_NAME, self.member_id, ttl_ms
+            )
+            with self._lock:
+                changed = is_leader and not self._is_leader
+                self._is_leader = is_leader
+                self._valid_until = renewed_at + self.lease_ttl
+            if changed:
+                logging.info("Watcher {} is now the leader".format(self.member_id))
+        else:
+            members = sorted(
+                self.db_client.register_member(
+                    COORDINATION_NAME, self.member_id, ttl_ms
+                )
+            )
+            with self._lock:
+                changed = members != self._members
+                if changed:
+                    self._build_ring(members)
+                self._valid_until = renewed_at + self.lease_ttl
+            if changed:
+                logging.info("Watcher members are now {}".format(members))
+
+        if changed:
+            self._changed.set()
+
+    def stop(self):
+        """
+        Stop renewing and hand over this replica's jobs right away
+        """
+        self._stop.set()
+        self._changed.set()
+        with self._lock:
+            self._valid_until = 0
+        if self.mode == "leader":
+            self.db_client.release_lease(COORDINATION_NAME, self.member_id)
+        elif self.mode == "shard":
+            self.db_client.unregister_member(COORDINATION_NAME, self.member_id)
+
+    def _build_ring(self, members: list):
+        ring = []
+        for member in members:
+            for i in range(self.virtual_nodes):
+                ring.append((self._hash("{}#{}".format(member, i)), member))
+        ring.sort()
+        self._members = members
+        self._ring = [point for point, _ in ring]
+        self._ring_owners = [member for _, member in ring]
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], "big")
@@ -0,0 +1,260 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from datetime import datetime, timezone
+import json
+import logging
+import threading
+
+# Third Party
+from kubernetes import client
+from kubernetes.client import V1Job
+
+
+class JobCache:
+    """
+    Informer-style local store of the Kubernetes jobs in the target namespace,
+    indexed by their job_id label. The store is filled once by a list call and
+    then kept current by feeding it the events of a watch, so that readers
+    never have to go back to the API server.
+
+    The store can also resume from a known resource version without listing.
+    Until the next resync, lookups of jobs it has not seen yet then fall back to
+    a narrow list call for that one job.
+
+    Only jobs matching label_selector are listed, page_size at a time. With
+    minimal_fields set, jobs are stored with just the metadata and status
+    fields the reconciler reads, and list pages are parsed from the raw
+    response instead of being deserialized into full V1Job models.
+    """
+
+    def __init__(
+        self,
+        batch_v1_api: client.BatchV1Api,
+        namespace: str,
+        label_selector: str = None,
+        page_size: int = 500,
+        minimal_fields: bool = False,
+    ):
+        self.batch_v1_api = batch_v1_api
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.page_size = page_size
+        self.minimal_fields = minimal_fields
+        self.resource_version = None
+        # Whether the store holds every job, rather than only those seen so far
+        self.synced = False
+        self._jobs = {}
+        # IDs of jobs deleted while a merging resync lists, None otherwise
+        self._deleted = None
+        self._lock = threading.Lock()
+
+    def resync(self, merge: bool = False) -> str:
+        """
+        List all jobs in the namespace and replace the contents of the store.
+        Returns the resource version the list was served at, which is where a
+        subsequent watch should start.
+
+        With merge, listed jobs are only added if the store does not have them
+        yet and the resource version is left alone. This fills a store that was
+        resumed while its watch keeps running, since the watch delivers every
+        change to the jobs it already has. Jobs the watch deletes while the
+        list runs are not added back.
+        """
+        if merge:
+            with self._lock:
+                self._deleted = set()
+        jobs = {}
+        continue_token = None
+        while True:
+            page, resource_version, continue_token = self._list_page(continue_token)
+            for job in page:
+                job_id = self.get_job_id(job)
+                if job_id:
+                    jobs[job_id] = job
+            if not continue_token:
+                break
+
+        with self._lock:
+            if merge:
+                for job_id, job in jobs.items():
+                    if job_id not in self._deleted:
+                        self._jobs.setdefault(job_id, job)
+            else:
+                self._jobs = jobs
+                self.resource_version = resource_version
+            self._deleted = None
+            self.synced = True
+        logging.info("Job cache synced with {} jobs".format(len(jobs)))
+        return self.resource_version
+
+    def resume(self, resource_version: str):
+        """
+        Start from a resource version saved earlier instead of listing all jobs
+        """
+        with self._lock:
+            self._jobs = {}
+            self.resource_version = resource_version
+            self.synced = False
+
+    def apply_event(self, event_type: str, job: V1Job):
+        """
+        Apply a single watch event about a job to the store
+        """
+        job_id = self.get_job_id(job)
+        if self.minimal_fields:
+            job = self._slim_job(job)
+        with self._lock:
+            self.resource_version = job.metadata.resource_version
+            if not job_id:
+                return
+            if event_type == "DELETED":
+                self._jobs.pop(job_id, None)
+                if self._deleted is not None:
+                    self._deleted.add(job_id)
+            else:
+                self._jobs[job_id] = job
+
+    def upsert(self, job: V1Job):
+        """
+        Add a job this process just created, so that it is found before the
+        watch delivers it. A job the store already has is at least as recent.
+        """
+        job_id = self.get_job_id(job)
+        if not job_id:
+            return
+        if self.minimal_fields:
+            job = self._slim_job(job)
+        with self._lock:
+            self._jobs.setdefault(job_id, job)
+
+    def apply_bookmark(self, resource_version: str):
+        """
+        Move the resource version forward to that of a bookmark event, which
+        carries no job
+        """
+        with self._lock:
+            self.resource_version = resource_version
+
+    def get(self, job_id: str) -> V1Job:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job or self.synced:
+                return job
+
+        # Not seen yet, look up just this job
+        selector = "job_id=" + job_id
+        if self.label_selector:
+            selector = self.label_selector + "," + selector
+        job_list = self.batch_v1_api.list_namespaced_job(
+            namespace=self.namespace, label_selector=selector, limit=1
+        )
+        if not job_list.items:
+            return None
+        job = job_list.items[0]
+        if self.minimal_fields:
+            job = self._slim_job(job)
+        with self._lock:
+            # An event seen in the meantime is at least as recent
+            return self._jobs.setdefault(job_id, job)
+
+    def snapshot(self) -> dict:
+        """
+        Return a shallow copy of the store, keyed by job_id
+        """
+        with self._lock:
+            return dict(self._jobs)
+
+    @staticmethod
+    def get_job_id(job: V1Job) -> str:
+        labels = job.metadata.labels or {}
+        return labels.get("job_id")
+
+    def _list_page(self, continue_token: str = None):
+        """
+        Fetch one page of jobs. Returns the jobs, the resource version of the list
+        and the token to fetch the next page with, if any.
+        """
+        kwargs = {
+            "namespace": self.namespace,
+            "limit": self.page_size,
+        }
+        if self.label_selector:
+            kwargs["label_selector"] = self.label_selector
+        if continue_token:
+            kwargs["_continue"] = continue_token
+
+        if not self.minimal_fields:
+            job_list = self.batch_v1_api.list_namespaced_job(**kwargs)
+            return (
+                job_list.items,
+                job_list.metadata.resource_version,
+                job_list.metadata._continue,
+            )
+
+        response = self.batch_v1_api.list_namespaced_job(
+            _preload_content=False, **kwargs
+        )
+        job_list = json.loads(response.data)
+        metadata = job_list.get("metadata", {})
+        jobs = [self._slim_job_from_dict(item) for item in job_list.get("items", [])]
+        return jobs, metadata.get("resourceVersion"), metadata.get("continue")
+
+    @staticmethod
+    def _slim_job(job: V1Job) -> V1Job:
+        status = job.status or client.V1JobStatus()
+        return V1Job(
+            metadata=client.V1ObjectMeta(
+                name=job.metadata.name,
+                namespace=job.metadata.namespace,
+                labels=job.metadata.labels,
+                resource_version=job.metadata.resource_version,
+                creation_timestamp=job.metadata.creation_timestamp,
+            ),
+            status=client.V1JobStatus(
+                start_time=status.start_time,
+                completion_time=status.completion_time,
+                active=status.active,
+                succeeded=status.succeeded,
+                failed=status.failed,
+            ),
+        )
+
+    @staticmethod
+    def _slim_job_from_dict(item: dict) -> V1Job:
+        metadata = item.get("metadata", {})
+        status = item.get("status", {})
+        return V1Job(
+            metadata=client.V1ObjectMeta(
+                name=metadata.get("name"),
+                namespace=metadata.get("namespace"),
+                labels=metadata.get("labels"),
+                resource_version=metadata.get("resourceVersion"),
+                creation_timestamp=_parse_time(metadata.get("creationTimestamp")),
+            ),
+            status=client.V1JobStatus(
+                start_time=_parse_time(status.get("startTime")),
+                completion_time=_parse_time(status.get("completionTime")),
+                active=status.get("active"),
+                succeeded=status.get("succeeded"),
+                failed=status.get("failed"),
+            ),
+        )
+
+
+def _parse_time(ts_str: str) -> datetime:
+    if not ts_str:
+        return None
+    return datetime.strptime(ts_str, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
@@ -0,0 +1,215 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from functools import wraps
+import asyncio
+import logging
+import threading
+import time
+
+# Kinds of Kubernetes calls, from highest to lowest priority
+LANES = ["delete", "create", "read", "logs"]
+
+# Kubernetes API methods that don't belong in the read lane
+METHOD_LANES = {
+    "create_namespaced_job": "create",
+    "delete_namespaced_job": "delete",
+    "read_namespaced_pod_log": "logs",
+}
+
+
+class PriorityRateLimiter:
+    """
+    Token bucket shared by all Kubernetes calls of a process, refilled at qps
+    tokens per second up to burst tokens.
+
+    Callers wait in one of the LANES. A token only goes to a lane when no
+    higher priority lane is waiting, so that for example cancellations are
+    not held up by a backlog of job launches.
+
+    Calls rejected with 429 or a 5xx status are retried up to max_retries
+    times. Each rejection pauses all lanes, for as long as the Retry-After
+    header asks or else for an exponentially growing delay of at most
+    max_backoff seconds.
+    """
+
+    def __init__(
+        self,
+        qps: float = 20,
+        burst: int = 40,
+        max_retries: int = 5,
+        max_backoff: float = 30,
+    ):
+        self.qps = qps
+        self.burst = burst
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+
+        self._tokens = burst
+        self._last_refill = time.monotonic()
+        self._waiting = {lane: 0 for lane in LANES}
+        self._paused_until = 0
+        self._backoff = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, lane: str):
+        """
+        Block until a call in the lane may go ahead
+        """
+        with self._cond:
+            self._waiting[lane] += 1
+            try:
+                while True:
+                    delay = self._take(lane)
+                    if not delay:
+                        return
+                    self._cond.wait(delay)
+            finally:
+                self._waiting[lane] -= 1
+                self._cond.notify_all()
+
+    async def acquire_async(self, lane: str):
+        """
+        Wait without blocking the event loop until a call in the lane may go ahead
+        """
+        with self._cond:
+            self._waiting[lane] += 1
+        try:
+            while True:
+                with self._cond:
+                    delay = self._take(lane)
+                if not delay:
+                    return
+                await asyncio.sleep(delay)
+        finally:
+            with self._cond:
+                self._waiting[lane] -= 1
+                self._cond.notify_all()
+
+    def call(self, lane: str, func, *args, **kwargs):
+        """
+        Call func once the lane allows it, retrying while the API server
+        rejects it as overloaded
+        """
+        attempt = 0
+        while True:
+            self.acquire(lane)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            self._succeeded()
+            return result
+
+    async def call_async(self, lane: str, func, *args, **kwargs):
+        """
+        Like call, for functions that return an awaitable
+        """
+        attempt = 0
+        while True:
+            await self.acquire_async(lane)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not self._should_retry(e, attempt):
+                    raise
+                attempt += 1
+                continue
+            self._succeeded()
+            return result
+
+    def _take(self, lane: str) -> float:
+        """
+        Take a token for the lane if it may have one. Returns 0 if it did,
+        otherwise how long to wait before trying again. Call with the lock held.
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._last_refill) * self.qps
+        )
+        self._last_refill = now
+        if self._tokens < 1:
+            return (1 - self._tokens) / self.qps
+
+        # Leave the token to a waiting lane of higher priority
+        for other in LANES[: LANES.index(lane)]:
+            if self._waiting[other]:
+                return 1 / self.qps
+
+        self._tokens -= 1
+        return 0
+
+    def _should_retry(self, e: Exception, attempt: int) -> bool:
+        """
+        Whether a failed call should be retried. If so, pause all lanes first.
+        """
+        status = getattr(e, "status", None)
+        if not status or (status != 429 and status < 500):
+            return False
+        if attempt >= self.max_retries:
+            return False
+
+        with self._cond:
+            self._backoff = min(self.max_backoff, (self._backoff or 0.5) * 2)
+            delay = self._retry_after(e) or self._backoff
+            self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        logging.warning(
+            "Kubernetes API server returned {}, pausing calls for {}s".format(
+                status, delay
+            )
+        )
+        return True
+
+    def _succeeded(self):
+        with self._cond:
+            self._backoff = 0
+
+    @staticmethod
+    def _retry_after(e: Exception) -> float:
+        headers = getattr(e, "headers", None) or {}
+        try:
+            return float(headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            return None
+
+
+class RateLimitedApi:
+    """
+    Wraps a Kubernetes API object so that every method call goes through the
+    rate limiter, in the lane given by METHOD_LANES or else the read lane
+    """
+
+    def __init__(self, api, limiter: PriorityRateLimiter):
+        self._api = api
+        self._limiter = limiter
+
+    def __getattr__(self, name: str):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+        lane = METHOD_LANES.get(name, "read")
+
+        # The docstring is kept, the watch reads the return type from it
+        @wraps(attr)
+        def rate_limited(*args, **kwargs):
+            return self._limiter.call(lane, attr, *args, **kwargs)
+
+        return rate_limited
@@ -0,0 +1,134 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+
+class Supervisor:
+    """
+    Runs long-lived tasks in their own daemon threads and restarts them when
+    they fail, until stop_event is set.
+
+    A task that raises is restarted after a delay that doubles on each failure
+    in a row, up to max_backoff seconds. A task that returns while the
+    supervisor is still running is restarted too, unless it was added as a
+    oneshot, which only runs until it completes once.
+    """
+
+    def __init__(
+        self,
+        stop_event: threading.Event,
+        initial_backoff: float = 1,
+        max_backoff: float = 60,
+    ):
+        self.stop_event = stop_event
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._threads = {}
+
+    def add(self, name: str, target, oneshot: bool = False) -> threading.Thread:
+        thread = threading.Thread(
+            target=self._supervise,
+            args=(name, target, oneshot),
+            name=name,
+            daemon=True,
+        )
+        self._threads[name] = thread
+        thread.start()
+        return thread
+
+    def join(self, names: list = None, timeout: float = None) -> list:
+        """
+        Wait for the named tasks, or all of them, to exit, for at most timeout
+        seconds in total. Returns the names of the tasks still running.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        if names is None:
+            names = list(self._threads)
+        for name in names:
+            remaining = None
+            if deadline is not None:
+                remaining = max(0, deadline - time.monotonic())
+            self._threads[name].join(remaining)
+        return [name for name in names if self._threads[name].is_alive()]
+
+    def _supervise(self, name: str, target, oneshot: bool):
+        backoff = self.initial_backoff
+        while not self.stop_event.is_set():
+            started = time.monotonic()
+            try:
+                target()
+                if oneshot or self.stop_event.is_set():
+                    return
+                logging.warning("Task {} exited, restarting it".format(name))
+            except Exception as e:
+                logging.error(
+                    "Task {} failed, restarting it in {}s".format(name, backoff)
+                )
+                logging.error(e)
+            # A task that ran fine for a while starts over with a short delay
+            if time.monotonic() - started > self.max_backoff:
+                backoff = self.initial_backoff
+            if self.stop_event.wait(backoff):
+                return
+            backoff = min(backoff * 2, self.max_backoff)
+
+
+class ReadWriteLock:
+    """
+    Lock that can be held by any number of shared holders at once, or by a
+    single exclusive holder. Once an exclusive holder is waiting, new shared
+    holders wait too, so it is not starved by a steady stream of them.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._shared = 0
+        self._exclusive = False
+        self._exclusive_waiting = 0
+
+    @contextmanager
+    def shared(self):
+        with self._cond:
+            while self._exclusive or self._exclusive_waiting:
+                self._cond.wait()
+            self._shared += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._shared -= 1
+                if not self._shared:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def exclusive(self):
+        with self._cond:
+            self._exclusive_waiting += 1
+            try:
+                while self._exclusive or self._shared:
+                    self._cond.wait()
+            finally:
+                self._exclusive_waiting -= 1
+            self._exclusive = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._exclusive = False
+                self._cond.notify_all()
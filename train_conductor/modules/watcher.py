@@ -13,11 +13,16 @@
 # limitations under the License.
 
 # Standard
+from datetime import datetime, timezone
+import asyncio
 import json
 import threading
 import base64
 import pickle
 import logging
+import random
+import signal
+import socket
 import time
 from enum import Enum
 
@@ -25,15 +30,35 @@ from enum import Enum
 from kubernetes import client, watch
 from kubernetes.client import Configuration, V1Job
 import kubernetes
+import urllib3
 
 # First Party
 import aconfig
 
 # Local
 from train_conductor.utils import error_check as error
-from train_conductor.datastore.redis import RedisHelper
+from train_conductor.datastore.database_base import RecordWrite
+from train_conductor.modules.admission import AdmissionController, admission_score
+from train_conductor.modules.async_kubernetes import AsyncKubernetesExecutor
+from train_conductor.modules.coordination import Coordinator
+from train_conductor.modules.job_cache import JobCache
+from train_conductor.modules.rate_limiter import PriorityRateLimiter, RateLimitedApi
+from train_conductor.modules.runtime import ReadWriteLock, Supervisor
+from train_conductor.modules.work_queue import KeyedWorkQueue
+from train_conductor.utils.helpers import (
+    configure_logging,
+    load_db_helper_class,
+    runtime_config_file,
+)
 from train_conductor.types import TrainingStatus, COMPLETED_STATES
 
+# Value of the app label set on every job the watcher creates
+JOB_APP_LABEL = "train-conductor-stack"
+# Consumer group the watchers read database changes through
+WATCHER_CONSUMER_GROUP = "train-conductor-watcher"
+# Checkpoint holding the resource version the job watch can resume from
+WATCH_CHECKPOINT = "watch_resource_version"
+
 
 class Watcher:
     def __init__(self, config: aconfig.Config):
@@ -41,7 +66,22 @@ class Watcher:
         self.config = config
         logging.info("Attempting connection to Redis")
 
-        self.db_client = RedisHelper(self.config)
+        # Writes made by the watcher are tagged, so that it is not notified
+        # of its own changes
+        self.db_client = load_db_helper_class(self.config)(
+            self.config, origin="watcher"
+        )
+
+        # Decides which jobs this replica reconciles when several run at once
+        coordination_config = config.trainer_config.coordination or {}
+        self.coordinator = Coordinator(
+            self.db_client,
+            member_id=socket.gethostname(),
+            mode=coordination_config.get("mode") or "none",
+            lease_ttl=coordination_config.get("lease_ttl") or 15,
+            virtual_nodes=coordination_config.get("virtual_nodes") or 64,
+            on_change=self.incremental_reconcile,
+        )
 
         self.tuning_image = self.config.trainer_config.tuning_image
         self.target_namespace = self.config.trainer_config.target_namespace
@@ -60,32 +100,281 @@ class Watcher:
         Configuration._default.verify_ssl = False
         #
 
-        self.batch_v1_api = client.BatchV1Api()
-        self.core_v1_api = client.CoreV1Api()
-        resource_version = self.full_reconcile()
+        # All Kubernetes calls share one rate limit, with deletes going first
+        rate_limit_config = config.trainer_config.api_rate_limit or {}
+        self.rate_limiter = PriorityRateLimiter(
+            qps=rate_limit_config.get("qps") or 20,
+            burst=rate_limit_config.get("burst") or 40,
+            max_retries=rate_limit_config.get("max_retries") or 5,
+            max_backoff=rate_limit_config.get("max_backoff") or 30,
+        )
+        self.batch_v1_api = RateLimitedApi(client.BatchV1Api(), self.rate_limiter)
+        self.core_v1_api = RateLimitedApi(client.CoreV1Api(), self.rate_limiter)
+
+        # The local job cache is kept current by the watch in monitor_jobs,
+        # and all reconcile paths read from it
+        job_list_config = config.trainer_config.job_list or {}
+        self.job_cache = JobCache(
+            self.batch_v1_api,
+            self.target_namespace,
+            label_selector="app=" + JOB_APP_LABEL,
+            page_size=job_list_config.get("page_size") or 500,
+            minimal_fields=bool(job_list_config.get("minimal_fields")),
+        )
+
+        # Jobs wait in the admission queue until their GPUs fit the quotas
+        self.admission = None
+        admission_config = config.trainer_config.admission or {}
+        if admission_config.get("enabled"):
+            self.admission = AdmissionController(
+                self.db_client,
+                self.job_cache,
+                self.coordinator,
+                default_gpus=config.trainer_config.default_resources.gpu or 1,
+                namespace_gpus=admission_config.get("namespace_gpus") or 0,
+                tenant_gpus=admission_config.get("tenant_gpus"),
+                default_tenant_gpus=admission_config.get("default_tenant_gpus") or 0,
+                scan_depth=admission_config.get("scan_depth") or 100,
+                reservation_ttl=admission_config.get("reservation_ttl") or 600,
+            )
+            self._admission_interval = admission_config.get("interval") or 5
+
+        self._checkpoint_interval = (
+            config.trainer_config.watch_checkpoint_interval or 10
+        )
+        self._last_checkpoint = 0
+
+        # Every reconcile request goes through the work queue, which collapses
+        # repeated requests for the same job
+        self._work_queue = KeyedWorkQueue()
+        self._num_workers = config.trainer_config.reconcile_workers or 4
+
+        # With the async engine, each worker reconciles a batch of jobs at a
+        # time and runs their Kubernetes calls concurrently
+        self.k8s_executor = None
+        engine_config = config.trainer_config.async_engine or {}
+        if engine_config.get("enabled"):
+            self.k8s_executor = AsyncKubernetesExecutor(
+                self.target_namespace,
+                create_concurrency=engine_config.get("create_concurrency") or 32,
+                delete_concurrency=engine_config.get("delete_concurrency") or 32,
+                log_concurrency=engine_config.get("log_concurrency") or 8,
+                connection_pool_size=engine_config.get("connection_pool_size") or 64,
+                limiter=self.rate_limiter,
+            )
+            self._batch_size = engine_config.get("batch_size") or 200
 
-        # Start DB listener thread
-        self._db_listener_thread = threading.Thread(
-            target=self.db_client.start_listener(self.db_update_event_handler)
+        self._reconcile_interval = config.trainer_config.reconcile_interval or 30
+        self._full_reconcile_interval = (
+            config.trainer_config.full_reconcile_interval or 3600
         )
+        self._shutdown_timeout = config.trainer_config.shutdown_timeout or 30
+
+        # Failed Kubernetes actions are retried with backoff, see plan_retry
+        retry_config = config.trainer_config.retry or {}
+        self._retry_base_delay = retry_config.get("base_delay") or 2
+        self._retry_max_delay = retry_config.get("max_delay") or 300
+        self._retry_max_attempts = retry_config.get("max_attempts") or 8
+        self._retry_poll_interval = retry_config.get("poll_interval") or 1
+
+        # Reconciles of a snapshot of all jobs hold this exclusively, and the
+        # workers reconciling single jobs hold it shared, so the two never
+        # act on the same job at once
+        self._reconcile_lock = ReadWriteLock()
+        self._stop_event = threading.Event()
+        self._stopped = threading.Event()
+        self._supervisor = Supervisor(self._stop_event)
+        self._worker_names = []
+        self._watch = None
+
+    def start(self):
+        """
+        Sync the job cache and start the watcher's tasks in the background: the
+        reconcile workers, the Kubernetes job watch, the database listener, the
+        periodic reconciler and, when enabled, replica coordination. Tasks that
+        fail are restarted by the supervisor.
+        """
+        worker = self.reconcile_worker
+        if self.k8s_executor:
+            self.k8s_executor.start()
+            worker = self.reconcile_batch_worker
+        for i in range(self._num_workers):
+            name = "reconcile-worker-{}".format(i)
+            self._supervisor.add(name, worker)
+            self._worker_names.append(name)
+
+        # Changes made while the watcher was down are still in the change
+        # stream, unread or unacknowledged by the consumer group, and their
+        # records are marked active, so only the active jobs need a look on
+        # startup. If the watch can resume where it left off, that happens in
+        # the background once the cache has been filled, so that events are
+        # handled right away.
+        resource_version = self.db_client.read_checkpoint(WATCH_CHECKPOINT)
+        if resource_version:
+            logging.info("Resuming watch from resource version " + resource_version)
+            self.job_cache.resume(resource_version)
+            self._supervisor.add("cache-warm-up", self.warm_up_job_cache, oneshot=True)
+        else:
+            self.job_cache.resync()
+            self.incremental_reconcile()
+
+        # Take part in coordination; gaining jobs triggers a reconcile of them
+        if self.coordinator.mode != "none":
+            self._supervisor.add("coordinator", self.coordinator.run)
+            self._supervisor.add(
+                "coordination-changes", self.coordinator.run_change_handler
+            )
+
+        # With coordination every replica needs to see every change to pick
+        # out its own jobs, so the consumer group, which hands each change to
+        # only one replica, is used only without it
         logging.info("Starting DB listener")
-        self._db_listener_thread.start()
+        self._supervisor.add(
+            "db-listener",
+            lambda: self.db_client.listen(
+                self.db_update_event_handler,
+                group=(
+                    WATCHER_CONSUMER_GROUP if self.coordinator.mode == "none" else None
+                ),
+                ignore_own=True,
+                stop_event=self._stop_event,
+            ),
+        )
+        self._supervisor.add("reconciler", self.run_periodic_reconcile)
+        self._supervisor.add("retry-poller", self.run_retry_poller)
+        if self.admission:
+            self._supervisor.add(
+                "admission",
+                lambda: self.admission.run(
+                    self._stop_event, self._admission_interval, self._work_queue.add
+                ),
+            )
+        self._supervisor.add("job-watch", self.run_job_watch)
 
-        # Start Full reconcile thread
-        self._reconcile_interval = config.get("trainer_config.reconcile_interval") or 30
-        self._reconcile_thread = threading.Thread(
-            target=self.start_full_reconcile_task(self._reconcile_interval)
+    def run(self):
+        """
+        Start the watcher and block until it is stopped by SIGTERM or SIGINT
+        """
+        signal.signal(signal.SIGTERM, lambda *_: self.stop())
+        signal.signal(signal.SIGINT, lambda *_: self.stop())
+        self.start()
+        self.wait()
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Block until the watcher has stopped
+        """
+        return self._stopped.wait(timeout)
+
+    def stop(self):
+        """
+        Stop all tasks. Jobs already taken from the work queue or queued for it
+        are reconciled first, for at most shutdown_timeout seconds, before this
+        replica gives up its jobs to the other replicas.
+        """
+        if self._stop_event.is_set():
+            return
+        logging.info("Stopping watcher")
+        self._stop_event.set()
+        if self.admission:
+            self.admission.wake()
+        if self._watch:
+            self._watch.stop()
+        self._work_queue.shut_down()
+        pending = self._supervisor.join(
+            self._worker_names, timeout=self._shutdown_timeout
         )
-        self._reconcile_thread.start()
+        if pending:
+            logging.warning(
+                "Reconcile workers {} did not finish before shutdown".format(pending)
+            )
+        try:
+            if self.k8s_executor:
+                self.k8s_executor.stop()
+            self.coordinator.stop()
+            self.checkpoint_resource_version(force=True)
+        except Exception as e:
+            logging.error("Failed to hand over watcher state on shutdown")
+            logging.error(e)
+        self._stopped.set()
+        logging.info("Watcher stopped")
+
+    def warm_up_job_cache(self):
+        """
+        Fill a resumed job cache with the jobs it has not seen, then reconcile
+        """
+        self.job_cache.resync(merge=True)
+        self.incremental_reconcile()
 
-        # Start Watching K8s
+    def run_job_watch(self):
+        """
+        Keep watching Kubernetes jobs until the watcher is stopped
+        """
+        while not self._stop_event.is_set():
+            self.monitor_jobs()
+
+    def run_periodic_reconcile(self):
+        """
+        Periodically reconcile the active jobs, with a full sweep of the database
+        every full_reconcile_interval seconds, until the watcher is stopped
+        """
+        last_full_reconcile = time.monotonic()
+        while not self._stop_event.wait(self._reconcile_interval):
+            if time.monotonic() - last_full_reconcile >= self._full_reconcile_interval:
+                self.full_reconcile()
+                last_full_reconcile = time.monotonic()
+            else:
+                self.incremental_reconcile()
+
+    def reconcile_worker(self):
+        """
+        Process jobs from the work queue until it is shut down
+        """
         while True:
-            self.monitor_jobs(resource_version)
+            job_id = self._work_queue.get()
+            if job_id is None:
+                return
+            if not self.coordinator.owns(job_id):
+                self._work_queue.done(job_id)
+                continue
+            try:
+                with self._reconcile_lock.shared():
+                    db_entry = self.db_client.read_record(job_id)
+                    self.reconcile_state(job_id, db_entry, self.job_cache.get(job_id))
+            except Exception as e:
+                logging.error("Failed to reconcile job {}".format(job_id))
+                logging.error(e)
+            finally:
+                self._work_queue.done(job_id)
 
-    def start_full_reconcile_task(self, interval):
+    def reconcile_batch_worker(self):
+        """
+        Process batches of jobs from the work queue until it is shut down. The
+        database side of a batch is read and written in a few round trips, and
+        the Kubernetes actions of all its jobs run concurrently.
+        """
         while True:
-            time.sleep(interval)
-            self.full_reconcile()
+            job_ids = self._work_queue.get_batch(self._batch_size)
+            if not job_ids:
+                return
+            try:
+                owned = [job_id for job_id in job_ids if self.coordinator.owns(job_id)]
+                with self._reconcile_lock.shared():
+                    db_entries = self.db_client.read_many_entries(owned)
+                    plans = [
+                        self.plan_reconcile(
+                            job_id, db_entries.get(job_id), self.job_cache.get(job_id)
+                        )
+                        for job_id in owned
+                    ]
+                    self.apply_plans(plans)
+                    self.run_actions_async(plans)
+            except Exception as e:
+                logging.error("Failed to reconcile jobs {}".format(job_ids))
+                logging.error(e)
+            finally:
+                for job_id in job_ids:
+                    self._work_queue.done(job_id)
 
     def reconcile_state(self, job_id: str, db_entry: dict, k8s_entry: V1Job):
         """
@@ -94,15 +383,36 @@ class Watcher:
         if not db_entry:
             db_entry = self.db_client.read_record(job_id)
 
+        if not k8s_entry:
+            k8s_entry = self.job_cache.get(job_id)
+
+        plan = self.plan_reconcile(job_id, db_entry, k8s_entry)
+        self.apply_plans([plan])
+        self.run_actions(plan)
+
+    def plan_reconcile(
+        self, job_id: str, db_entry: dict, k8s_entry: V1Job
+    ) -> "ReconcilePlan":
+        """
+        Work out the database writes and Kubernetes actions needed to bring a job's
+        database record and Kubernetes state in line, without applying any of them
+        """
+        plan = ReconcilePlan(job_id)
+        if db_entry:
+            plan.retry_attempts = int(db_entry.get("retry_attempts") or 0)
+
         if not db_entry:
+            if not k8s_entry:
+                # Nothing left to reconcile for this key
+                plan.inactive = True
+                return plan
             logging.info(
                 "Job exists in kubernetes but not database. Deleting {}".format(job_id)
             )
-            self.delete_job(
-                job_id=job_id,
-                job_name=self.generate_k8s_job_name(job_id),
-                namespace=self.target_namespace,
+            plan.actions.append(
+                ("delete", {"job_name": k8s_entry.metadata.name, "record": False})
             )
+            return plan
 
         db_state = db_entry.get("status")
         if db_state:
@@ -111,46 +421,38 @@ class Watcher:
             db_state = TrainingStatus.PLACEHOLDER_UNSET
 
         if db_state in COMPLETED_STATES and db_entry.get("deleted") and not k8s_entry:
-            return
+            plan.inactive = True
+            return plan
 
         if not k8s_entry:
-            try:
-                k8s_entry = self.batch_v1_api.read_namespaced_job(
-                    namespace=self.target_namespace,
-                    name=self.generate_k8s_job_name(job_id),
+            logging.info("Job {} not found in k8s".format(job_id))
+            if db_state in COMPLETED_STATES:
+                logging.info(
+                    "Job {} already completed = {}".format(job_id, db_state.name)
                 )
-            except client.exceptions.ApiException as e:
-                logging.info("Job {} not found in k8s".format(job_id))
-                if db_state in COMPLETED_STATES:
-                    logging.info(
-                        "Job {} already completed = {}".format(job_id, db_state.name)
-                    )
-                    if not db_entry.get("deleted"):
-                        self.db_client.write_field(job_id, "deleted", "1")
-                    return
-                else:
-                    logging.info(
-                        "Current job state for job {}: {}".format(job_id, db_state.name)
+                if not db_entry.get("deleted"):
+                    plan.writes.append(
+                        RecordWrite(job_id, {"deleted": "1"}, notify=False)
                     )
-                    logging.info("Launching job {} in Kubernetes".format(job_id))
-                    env_vars = ""
-                    params = db_entry.get("parameters")
-                    if params:
-                        try:
-                            env_vars = json.loads(params)
-                        except:
-                            logging.error(
-                                "Could not load env vars for job {}".format(job_id)
+            else:
+                logging.info(
+                    "Current job state for job {}: {}".format(job_id, db_state.name)
+                )
+                if self.admission and not self.admission.is_admitted(job_id):
+                    logging.info("Job {} is waiting for admission".format(job_id))
+                    plan.admission_score = admission_score(db_entry)
+                    if db_state == TrainingStatus.PLACEHOLDER_UNSET:
+                        plan.writes.append(
+                            RecordWrite(
+                                job_id,
+                                {},
+                                status=TrainingStatus.QUEUED,
+                                expected=db_state,
                             )
-                    self.create_job(
-                        job_id=job_id,
-                        image=self.tuning_image,
-                        image_pull_secrets=self.config.trainer_config.image_pull_secrets,
-                        gpus=env_vars.get("num_gpus")
-                        or self.config.trainer_config.default_resources.gpu,
-                        env_vars=env_vars,
-                    )
-                    return
+                        )
+                else:
+                    plan.actions.append(("create", {"db_entry": db_entry}))
+            return plan
 
         # Job exists in DB and K8s. See if we need to update DB status.
         k8s_state = k8s_entry.status
@@ -164,23 +466,250 @@ class Watcher:
             # If DB indicates canceled, we need to cancel and delete
             if db_state == TrainingStatus.CANCELED:
                 logging.info("Canceling job " + job_id)
-                self.delete_job(
-                    job_id=job_id,
-                    job_name=k8s_entry.metadata.name,
-                    namespace=self.target_namespace,
-                )
-                return
+                plan.actions.append(("delete", {"job_name": k8s_entry.metadata.name}))
+                return plan
 
-            # Otherwise, update DB to reflect actual state in k8s
-            self.db_client.write_field(job_id, "status", str(actual_state.name))
+            # Otherwise, update DB to reflect actual state in k8s, unless the
+            # status was changed concurrently; that change triggers a new reconcile
+            fields = {}
+            if not db_entry.get("submission_timestamp"):
+                fields["submission_timestamp"] = self._format_timestamp(
+                    k8s_entry.metadata.creation_timestamp
+                )
+            if actual_state in COMPLETED_STATES and not db_entry.get(
+                "completion_timestamp"
+            ):
+                completion_time = k8s_state.completion_time or datetime.now(
+                    timezone.utc
+                )
+                fields["completion_timestamp"] = self._format_timestamp(completion_time)
+                # Run times feed the wait time estimates of queued jobs
+                if k8s_state.start_time:
+                    plan.duration = (
+                        completion_time - k8s_state.start_time
+                    ).total_seconds()
+            plan.writes.append(
+                RecordWrite(job_id, fields, status=actual_state, expected=db_state)
+            )
         if actual_state in COMPLETED_STATES and not db_entry.get("deleted"):
             logging.info("Job has compelted, deleting from k8s " + job_id)
-            self.capture_failed_state(job_id=job_id, job=k8s_entry)
-            self.delete_job(job_id, k8s_entry.metadata.name, self.target_namespace)
+            plan.actions.append(("capture_logs", {"job": k8s_entry}))
+            plan.actions.append(("delete", {"job_name": k8s_entry.metadata.name}))
+        return plan
 
-    def capture_failed_state(self, job_id: str, job: V1Job):
+    def apply_plans(self, plans: list):
+        """
+        Apply the database side of many reconcile plans in a few pipelined batches
+        """
+        writes = [write for plan in plans for write in plan.writes]
+        if writes:
+            results = self.db_client.write_batch(writes)
+            for write, result in zip(writes, results):
+                if write.status and not result[0]:
+                    logging.info(
+                        "Status of job {} changed since it was read, not updating".format(
+                            write.key
+                        )
+                    )
+        self.db_client.mark_inactive(*[plan.job_id for plan in plans if plan.inactive])
+        self.db_client.record_durations(
+            *[plan.duration for plan in plans if plan.duration is not None]
+        )
+        queued = {
+            plan.job_id: plan.admission_score
+            for plan in plans
+            if plan.admission_score is not None
+        }
+        if queued:
+            self.db_client.enqueue_admission(queued)
+            self.admission.wake()
+
+    def run_actions(self, plan: "ReconcilePlan"):
+        """
+        Run the Kubernetes actions of a reconcile plan, then record their outcome
+        in the database in a single batch
+        """
+        writes = []
+        for action, kwargs in plan.actions:
+            try:
+                if action == "create":
+                    write = self.launch_job(plan.job_id, **kwargs)
+                elif action == "delete":
+                    write = self.delete_job(
+                        plan.job_id, namespace=self.target_namespace, **kwargs
+                    )
+                elif action == "capture_logs":
+                    write = self.capture_failed_state(plan.job_id, **kwargs)
+            except Exception as e:
+                writes.extend(self.plan_retry(plan, action, e))
+                break
+            if write:
+                writes.append(write)
+        else:
+            writes.extend(self._retry_reset(plan))
+        if writes:
+            self.db_client.write_batch(writes)
+
+    def run_actions_async(self, plans: list):
+        """
+        Run the Kubernetes actions of many reconcile plans concurrently on the
+        async engine, then record their outcome in the database in batches.
+        The actions of one plan still run in order.
+        """
+
+        action_plans = [plan for plan in plans if plan.actions]
+
+        async def run_all():
+            return await asyncio.gather(
+                *[self._run_plan_async(plan) for plan in action_plans]
+            )
+
+        writes = []
+        for plan, (plan_writes, failure) in zip(
+            action_plans, self.k8s_executor.run(run_all())
+        ):
+            writes.extend(plan_writes)
+            if failure:
+                writes.extend(self.plan_retry(plan, *failure))
+            else:
+                writes.extend(self._retry_reset(plan))
+        if writes:
+            self.db_client.write_batch(writes)
+
+    async def _run_plan_async(self, plan: "ReconcilePlan"):
+        """
+        Run the actions of a plan in order. Returns their writes, and the action
+        and exception that stopped the plan, if any.
+        """
+        writes = []
+        for action, kwargs in plan.actions:
+            try:
+                write = await self._run_action_async(plan.job_id, action, kwargs)
+            except Exception as e:
+                return writes, (action, e)
+            if write:
+                writes.append(write)
+        return writes, None
+
+    async def _run_action_async(self, job_id: str, action: str, kwargs: dict):
+        if action == "create":
+            logging.info("Launching job {} in Kubernetes".format(job_id))
+            job_name, job_body = self.build_job_body(
+                **self._launch_args(job_id, kwargs["db_entry"])
+            )
+            job = await self.k8s_executor.create_job(
+                self.batch_v1_api.api_client.sanitize_for_serialization(job_body)
+            )
+            logging.info("Created job for id {}".format(job_id))
+            self.job_cache.upsert(job)
+            return self._launch_write(job_id, job_name, job)
+        if action == "delete":
+            await self.k8s_executor.delete_job(kwargs["job_name"])
+            logging.info("Deleted job for id " + job_id)
+            if kwargs.get("record", True):
+                return RecordWrite(job_id, {"deleted": "1"}, notify=False)
+        elif action == "capture_logs":
+            logs = await self.k8s_executor.get_job_logs(kwargs["job"].metadata.name)
+            return RecordWrite(job_id, {"errors": logs})
+
+    def plan_retry(self, plan: "ReconcilePlan", action: str, e: Exception) -> list:
+        """
+        Schedule another reconcile of a job whose Kubernetes action failed, after a
+        jittered backoff that doubles with each failure in a row. Once a job has
+        failed max_attempts times it is marked FAILED instead. Returns the writes
+        that record the attempt.
+        """
+        job_id = plan.job_id
+        logging.error("Unable to {} job {}".format(action, job_id))
+        logging.error(e)
+        # Jobs without a record can't keep count, they are retried at the base delay
+        attempts = (plan.retry_attempts or 0) + 1
+        if plan.retry_attempts is not None and attempts >= self._retry_max_attempts:
+            logging.error(
+                "Giving up on job {} after {} failed attempts".format(job_id, attempts)
+            )
+            self.db_client.clear_retries(job_id)
+            if self.admission:
+                self.admission.release(job_id)
+            reason = "Failed to {} the job after {} attempts: {}".format(
+                action, attempts, e
+            )
+            return [
+                RecordWrite(
+                    job_id,
+                    {
+                        "errors": reason,
+                        "retry_attempts": attempts,
+                        "completion_timestamp": self._format_timestamp(
+                            datetime.now(timezone.utc)
+                        ),
+                    },
+                    status=TrainingStatus.FAILED,
+                )
+            ]
+
+        delay = min(self._retry_max_delay, self._retry_base_delay * 2 ** (attempts - 1))
+        delay = delay / 2 + random.uniform(0, delay / 2)
+        logging.info("Will try again in {:.1f}s {}".format(delay, job_id))
+        self.db_client.schedule_retry(job_id, time.time() + delay)
+        if plan.retry_attempts is None:
+            return []
+        return [RecordWrite(job_id, {"retry_attempts": attempts}, notify=False)]
+
+    @staticmethod
+    def _retry_reset(plan: "ReconcilePlan") -> list:
+        """
+        Writes that reset the failure count of a job whose actions all succeeded
+        """
+        if not plan.retry_attempts:
+            return []
+        return [RecordWrite(plan.job_id, {"retry_attempts": 0}, notify=False)]
+
+    def run_retry_poller(self):
+        """
+        Hand the jobs whose retry is due to the reconcile workers, until the
+        watcher is stopped
+        """
+        while not self._stop_event.wait(self._retry_poll_interval):
+            job_ids = [
+                job_id
+                for job_id in self.db_client.due_retries(time.time(), count=500)
+                if self.coordinator.owns(job_id)
+            ]
+            if not job_ids:
+                continue
+            self.db_client.clear_retries(*job_ids)
+            for job_id in job_ids:
+                self._work_queue.add(job_id)
+
+    def launch_job(self, job_id: str, db_entry: dict) -> RecordWrite:
+        logging.info("Launching job {} in Kubernetes".format(job_id))
+        return self.create_job(**self._launch_args(job_id, db_entry))
+
+    def _launch_args(self, job_id: str, db_entry: dict) -> dict:
+        """
+        Arguments to create_job for the job of a database record
+        """
+        env_vars = {}
+        params = db_entry.get("parameters")
+        if params:
+            try:
+                env_vars = json.loads(params)
+            except:
+                logging.error("Could not load env vars for job {}".format(job_id))
+        return {
+            "job_id": job_id,
+            "tenant": db_entry.get("tenant"),
+            "image": self.tuning_image,
+            "image_pull_secrets": self.config.trainer_config.image_pull_secrets,
+            "gpus": env_vars.get("num_gpus")
+            or self.config.trainer_config.default_resources.gpu,
+            "env_vars": env_vars,
+        }
+
+    def capture_failed_state(self, job_id: str, job: V1Job) -> RecordWrite:
         logs = self.get_job_logs(job)
-        self.db_client.write_field(job_id, "errors", logs)
+        return RecordWrite(job_id, {"errors": logs})
 
     def get_job_logs(self, job: V1Job):
         logs = ""
@@ -199,90 +728,179 @@ class Watcher:
                 logging.debug("Could not retreive logs for pod " + pod_name)
         return logs
 
-    def monitor_jobs(self, resource_version):
+    def monitor_jobs(self):
         """
-        Function for keeping watch on events in Kubernetes, and reconciling each change
+        Function for keeping watch on events in Kubernetes, and reconciling each change.
+        Every event is also applied to the job cache, which tracks the resource version
+        to resume from on the next iteration.
         """
         try:
-            w = watch.Watch()
+            w = self._watch = watch.Watch()
             for event in w.stream(
                 self.batch_v1_api.list_namespaced_job,
                 namespace=self.target_namespace,
+                label_selector=self.job_cache.label_selector,
                 timeout_seconds=0,
-                resource_version=resource_version,
+                resource_version=self.job_cache.resource_version,
+                allow_watch_bookmarks=True,
             ):
-                # Save new resource version to use on next iteration
-                resource_version = event["object"].metadata.resource_version
-
-                job_id = event["object"].metadata.labels.get("job_id")
+                if event["type"] == "BOOKMARK":
+                    # Bookmarks only tell how far the watch has got. Their object
+                    # is the raw dict, not a V1Job.
+                    self.job_cache.apply_bookmark(
+                        event["raw_object"]["metadata"]["resourceVersion"]
+                    )
+                    self.checkpoint_resource_version()
+                    continue
+                self.job_cache.apply_event(event["type"], event["object"])
+                self.checkpoint_resource_version()
+                job_status = event["object"].status
+                if self.admission and (
+                    event["type"] == "DELETED"
+                    or (job_status and (job_status.succeeded or job_status.failed))
+                ):
+                    # GPUs were freed
+                    self.admission.wake()
 
-                db_record = self.db_client.read_record(job_id)
-                self.reconcile_state(job_id, db_record, event["object"])
+                job_id = self.job_cache.get_job_id(event["object"])
+                if job_id and self.coordinator.owns(job_id):
+                    self._work_queue.add(job_id)
 
         except client.exceptions.ApiException as e:
             if (
                 e.status != 410
             ):  # Not a "Gone" exception, indicating resourceVersion too old
                 raise
-            # Our resource version was too old, so run a full reconcile
-            logging.error("Encountered exception, starting full reconcile, " + e)
-            resource_version = self.full_reconcile()
+            # Our resource version was too old, so relist and run a full reconcile
+            logging.error("Encountered exception, starting full reconcile, " + str(e))
+            self.job_cache.resync()
+            self.checkpoint_resource_version(force=True)
+            self.full_reconcile()
         except Exception as e:
             # Just log other errors
             logging.error("Exception in watch")
             logging.error(e)
 
-    def scan_db_entries(self):
+    def checkpoint_resource_version(self, force: bool = False):
         """
-        Utility for fetching multiple keys and values from the database at once
+        Save the resource version of the watch, at most every watch_checkpoint_interval
+        seconds, so that a restarted watcher can resume without listing all jobs
+        """
+        now = time.monotonic()
+        if not force and now - self._last_checkpoint < self._checkpoint_interval:
+            return
+        self._last_checkpoint = now
+        if self.job_cache.resource_version:
+            self.db_client.write_checkpoint(
+                WATCH_CHECKPOINT, self.job_cache.resource_version
+            )
+
+    def scan_db_entries(self, active_only: bool = False):
+        """
+        Utility for fetching multiple keys and values from the database at once.
+        Only records of jobs this replica owns are fetched.
         """
         cursor = "0"
         while cursor != 0:
-            cursor, keys = self.db_client.iterate_entries(cursor=cursor)
+            if active_only:
+                cursor, keys = self.db_client.iterate_active_entries(cursor=cursor)
+            else:
+                cursor, keys = self.db_client.iterate_entries(cursor=cursor)
+            keys = [key for key in keys if self.coordinator.owns(key)]
             values = self.db_client.read_many_entries(keys)
+            if not active_only:
+                # Records written before the indexes existed are only found by
+                # scanning, so the full sweep adds each one it visits
+                self.db_client.index_entries(values)
             yield from values.items()
 
     def full_reconcile(self):
+        """
+        Reconcile every job in the database and in Kubernetes
+        """
         logging.info("Beginning full reconcile")
-        job_list = self.batch_v1_api.list_namespaced_job(
-            namespace=self.target_namespace
+        self.reconcile_snapshot(self.scan_db_entries())
+        logging.info("Completed full reconcile")
+
+    def incremental_reconcile(self):
+        """
+        Reconcile only the records marked active in the database, plus the jobs
+        currently in Kubernetes, so the cost scales with active jobs rather than
+        the whole job history
+        """
+        logging.info("Beginning incremental reconcile")
+        self.reconcile_snapshot(self.scan_db_entries(active_only=True))
+        logging.info("Completed incremental reconcile")
+
+    def reconcile_snapshot(self, db_entries):
+        """
+        Diff a snapshot of database records against the job cache, apply all the
+        resulting database writes in batches, then queue the jobs that need
+        Kubernetes actions for the reconcile workers
+        """
+        if not self.job_cache.synced:
+            # A missing job would look deleted, wait for the cache warm-up
+            logging.info("Job cache is not synced yet, skipping reconcile")
+            return
+        with self._reconcile_lock.exclusive():
+            plans = self._plan_snapshot(db_entries)
+
+        # Workers plan these jobs again against their latest state before acting.
+        # Jobs waiting out a retry backoff are left to the retry poller.
+        action_plans = [plan for plan in plans if plan.actions]
+        if action_plans:
+            retries = self.db_client.read_retries(
+                [plan.job_id for plan in action_plans]
+            )
+            now = time.time()
+            action_plans = [
+                plan for plan in action_plans if retries.get(plan.job_id, 0) <= now
+            ]
+        for plan in action_plans:
+            self._work_queue.add(plan.job_id)
+        logging.info(
+            "Reconciled {} jobs, {} need Kubernetes actions".format(
+                len(plans), len(action_plans)
+            )
         )
-        resource_version = job_list.metadata.resource_version
-        current_jobs = job_list.items
-        job_dict = {}
-        for job in current_jobs:
-            job_dict[job.metadata.labels.get("job_id")] = job
 
-        for job_id, db_entry in self.scan_db_entries():
-            logging.info(
-                "Evaluating job " + job_id + " with status " + db_entry.get("status")
+    def _plan_snapshot(self, db_entries) -> list:
+        """
+        Plan and apply the database writes for a snapshot of database records and
+        the job cache. Returns the plans.
+        """
+        job_dict = {
+            job_id: job
+            for job_id, job in self.job_cache.snapshot().items()
+            if self.coordinator.owns(job_id)
+        }
+        plans = []
+        for job_id, db_entry in db_entries:
+            plans.append(
+                self.plan_reconcile(job_id, db_entry, job_dict.pop(job_id, None))
             )
-            self.reconcile_state(job_id, db_entry, job_dict.pop(job_id, None))
 
-        # Jobs in K8s that are not not in DB
-        for job_id, job in job_dict.items():
-            job_id = job.metadata.labels.get("job_id")
-            db_entry = self.db_client.read_record(job_id)
-            self.reconcile_state(job_id, db_entry, job)
+        # Jobs in K8s whose records were not in the snapshot
+        if job_dict:
+            k8s_only = self.db_client.read_many_entries(list(job_dict))
+            for job_id, db_entry in k8s_only.items():
+                plans.append(self.plan_reconcile(job_id, db_entry, job_dict[job_id]))
 
-        logging.info("Completed full reconcile")
-        return resource_version
+        self.apply_plans(plans)
+        return plans
 
-    def delete_job(self, job_id, job_name, namespace):
-        try:
-            # Propogation policy makes sure that pods belonging to the job get deleted as well, asynchronously
-            self.batch_v1_api.delete_namespaced_job(
-                name=job_name, namespace=namespace, propagation_policy="Background"
-            )
-            logging.info("Deleted job for id " + job_id)
-            self.db_client.write_field(job_id, "deleted", "1")
-        except Exception as e:
-            logging.error(
-                "Unable to delete job will try again later "
-                + job_id
-                + " Error: "
-                + str(e)
-            )
+    def delete_job(self, job_id, job_name, namespace, record: bool = True):
+        """
+        Delete a job from Kubernetes. Returns the write that flags the record as
+        deleted, unless record is False.
+        """
+        # Propogation policy makes sure that pods belonging to the job get deleted as well, asynchronously
+        self.batch_v1_api.delete_namespaced_job(
+            name=job_name, namespace=namespace, propagation_policy="Background"
+        )
+        logging.info("Deleted job for id " + job_id)
+        if record:
+            return RecordWrite(job_id, {"deleted": "1"}, notify=False)
 
     def k8s_job_status_to_enum(self, k8s_job_status):
         job_status = TrainingStatus.QUEUED
@@ -295,26 +913,53 @@ class Watcher:
                 job_status = TrainingStatus.RUNNING
         return job_status
 
-    def db_update_event_handler(self, msg):
-        job_id = msg.get("data")
+    def db_update_event_handler(self, job_id: str):
+        if not self.coordinator.owns(job_id):
+            return
         logging.info("Recieved DB update for job {}".format(job_id))
-        record = self.db_client.read_record(job_id)
-        self.reconcile_state(job_id, record, None)
+        self._work_queue.add(job_id)
 
     def generate_k8s_job_name(self, job_id: str):
         return "train-conductor-tuning-job" + "." + job_id
 
-    def create_job(
+    def create_job(self, job_id: str, **kwargs) -> RecordWrite:
+        """
+        Create a job in Kubernetes. Takes the arguments of build_job_body and
+        returns the write that records the launch.
+        """
+        job_name, job_body = self.build_job_body(job_id, **kwargs)
+        try:
+            job = self.batch_v1_api.create_namespaced_job(
+                body=job_body, namespace=self.target_namespace
+            )
+            logging.info("Created job for id {}".format(job_id))
+        except client.exceptions.ApiException as e:
+            if e.status != 409:
+                raise
+            # Created by an earlier attempt whose outcome was not recorded
+            logging.info("Job for id {} already exists".format(job_id))
+            job = self.batch_v1_api.read_namespaced_job(
+                name=job_name, namespace=self.target_namespace
+            )
+        self.job_cache.upsert(job)
+        return self._launch_write(job_id, job_name, job)
+
+    def build_job_body(
         self,
         job_id: str,
         image: str,
-        app: str = "train-conductor-stack",
+        app: str = JOB_APP_LABEL,
         container_name: str = "train-conductor-training",
         image_pull_secrets: str = None,
         gpus: int = 0,
         backoff_limit=0,
         env_vars: dict = None,
+        tenant: str = None,
     ):
+        """
+        Build the Kubernetes Job for a training job. Returns the name of the job
+        and its body.
+        """
         job_name = self.generate_k8s_job_name(job_id)
 
         job_timeout = self.config.trainer_config.job_time_limit or 0
@@ -373,35 +1018,36 @@ class Watcher:
             active_deadline_seconds=job_timeout,
         )
 
-        # Define the Job
+        # Define the Job. The admission controller counts GPUs in use from its labels.
+        labels = {"app": app, "job_id": job_id, "gpus": str(gpus)}
+        if tenant:
+            labels["tenant"] = tenant
         job_body = client.V1Job(
             api_version="batch/v1",
             kind="Job",
-            metadata=client.V1ObjectMeta(name=job_name),
+            metadata=client.V1ObjectMeta(name=job_name, labels=labels),
             spec=job_spec,
         )
+        return job_name, job_body
 
-        try:
-            job = self.batch_v1_api.create_namespaced_job(
-                body=job_body, namespace=self.target_namespace
-            )
-        except Exception as e:
-            logging.error(
-                "Exception encountered attempting to create job. Will try again later. "
-                + job_id
-            )
-            logging.error(e)
-            return
-
-        logging.info("Created job for id {}".format(job_id))
-        self.db_client.write_field(
+    def _launch_write(self, job_id: str, job_name: str, job: V1Job) -> RecordWrite:
+        # If the job was canceled in the meantime this is a no-op, and the
+        # cancellation deletes the job we just created
+        return RecordWrite(
             job_id,
-            "submission_timestamp",
-            job.metadata.creation_timestamp.strftime("%m/%d/%Y %H:%M:%S"),
+            {
+                "submission_timestamp": self._format_timestamp(
+                    job.metadata.creation_timestamp
+                ),
+                "job_name": job_name,
+                "namespace": job.metadata.namespace,
+            },
+            status=TrainingStatus.PENDING,
         )
-        self.db_client.write_field(job_id, "job_name", job_name)
-        self.db_client.write_field(job_id, "namespace", job.metadata.namespace)
-        self.db_client.write_field(job_id, "status", TrainingStatus.PENDING.name)
+
+    @staticmethod
+    def _format_timestamp(ts: datetime) -> str:
+        return ts.strftime("%m/%d/%Y %H:%M:%S")
 
     @staticmethod
     def _obj_to_txt(obj):
@@ -411,7 +1057,34 @@ class Watcher:
         return txt
 
 
+class ReconcilePlan:
+    """
+    The changes needed to bring one job's database record and Kubernetes state in line
+    """
+
+    def __init__(self, job_id: str):
+        self.job_id = job_id
+        # RecordWrites to apply to the database
+        self.writes = []
+        # Kubernetes actions to take, as (action name, keyword arguments)
+        self.actions = []
+        # Whether the record needs no further reconciliation
+        self.inactive = False
+        # Failed attempts at the job's actions so far, None if it has no record
+        self.retry_attempts = None
+        # Position in the admission queue, if the job has to wait for admission
+        self.admission_score = None
+        # Run time in seconds, if the job just finished
+        self.duration = None
+
+
+def main(config_file: str = None):
+    config_file = config_file or runtime_config_file()
+    configure_logging()
+    # TODO: Hack to supress certificate check warnings. Needs fixing.
+    urllib3.disable_warnings()
+    Watcher(aconfig.Config.from_yaml(config_file)).run()
+
+
 if __name__ == "__main__":
-    # For testing purposes
-    config = aconfig.Config.from_yaml("runtime_config.yml")
-    Watcher(config)
+    main()
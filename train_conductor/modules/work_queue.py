@@ -0,0 +1,101 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from collections import deque
+import threading
+
+
+class KeyedWorkQueue:
+    """
+    FIFO queue of keys to reconcile, shared by a pool of workers.
+
+    A key that is added while it is already pending is only queued once. A key
+    that is added while a worker is processing it is queued again only after
+    that worker calls done(), so a key is never processed by two workers at the
+    same time and events for one key are handled in order.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._queue = deque()
+        # Keys that need processing, whether queued or waiting on a worker
+        self._dirty = set()
+        # Keys currently held by a worker
+        self._processing = set()
+        self._shutting_down = False
+
+    def add(self, key: str):
+        with self._cond:
+            if self._shutting_down or key in self._dirty:
+                return
+            self._dirty.add(key)
+            if key in self._processing:
+                return
+            self._queue.append(key)
+            self._cond.notify()
+
+    def get(self, timeout: float = None) -> str:
+        """
+        Block until a key is available and hand it to the caller, who must call
+        done() with it once finished. Returns None on timeout, or once the queue
+        has been shut down and drained.
+        """
+        with self._cond:
+            while not self._queue and not self._shutting_down:
+                if not self._cond.wait(timeout):
+                    return None
+            if not self._queue:
+                return None
+            key = self._queue.popleft()
+            self._dirty.discard(key)
+            self._processing.add(key)
+            return key
+
+    def get_batch(self, max_keys: int, timeout: float = None) -> list:
+        """
+        Like get, but once a key is available hand out up to max_keys of the
+        queued keys at once, without waiting for more. done() must be called
+        with each of them. Returns an empty list where get returns None.
+        """
+        key = self.get(timeout)
+        if key is None:
+            return []
+        keys = [key]
+        with self._cond:
+            while self._queue and len(keys) < max_keys:
+                key = self._queue.popleft()
+                self._dirty.discard(key)
+                self._processing.add(key)
+                keys.append(key)
+        return keys
+
+    def done(self, key: str):
+        with self._cond:
+            self._processing.discard(key)
+            if key in self._dirty:
+                self._queue.append(key)
+                self._cond.notify()
+
+    def shut_down(self):
+        """
+        Stop accepting new keys. Keys already queued are still handed out.
+        """
+        with self._cond:
+            self._shutting_down = True
+            self._cond.notify_all()
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._queue)
@@ -0,0 +1,145 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+import logging
+import multiprocessing
+import signal
+import threading
+
+# First Party
+from aconfig import Config
+
+# Local
+from train_conductor.modules.runtime import Supervisor
+from train_conductor.utils.helpers import configure_logging, runtime_config_file
+
+
+def run_api_worker(config_file: str):
+    """
+    Serve gRPC in a process that shares the port with the other API workers
+    """
+    # Local
+    from train_conductor.grpc_server import serve
+
+    configure_logging()
+    serve(config_file, serve_grpc=True, run_watcher=False, reuse_port=True)
+
+
+def run_watcher(config_file: str):
+    # Local
+    from train_conductor.modules.watcher import main
+
+    main(config_file)
+
+
+class ProcessSupervisor:
+    """
+    Runs api_workers gRPC server processes that share the port through
+    SO_REUSEPORT, and one watcher process, so that handling requests and
+    reconciling jobs don't compete for one interpreter lock. Processes that
+    exit are started again, with the backoff of the runtime Supervisor.
+
+    Processes are spawned rather than forked, since gRPC does not support
+    forking once it is in use.
+    """
+
+    def __init__(
+        self,
+        config_file: str,
+        api_workers: int = 2,
+        watcher: bool = True,
+        shutdown_timeout: float = 30,
+    ):
+        self.config_file = config_file
+        self.api_workers = api_workers
+        self.watcher = watcher
+        self.shutdown_timeout = shutdown_timeout
+
+        self._context = multiprocessing.get_context("spawn")
+        self._stop_event = threading.Event()
+        self._supervisor = Supervisor(self._stop_event)
+        self._processes = {}
+        self._lock = threading.Lock()
+
+    def run(self):
+        """
+        Start the processes and block until they are stopped by SIGTERM or SIGINT
+        """
+        signal.signal(signal.SIGTERM, lambda *_: self._stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: self._stop_event.set())
+        self.start()
+        # Waiting with a timeout lets the signal handlers run
+        while not self._stop_event.wait(1):
+            pass
+        self.stop()
+
+    def start(self):
+        for index in range(self.api_workers):
+            self._add("api-{}".format(index), run_api_worker)
+        if self.watcher:
+            self._add("watcher", run_watcher)
+
+    def stop(self):
+        """
+        Ask all processes to stop, and kill those still running after
+        shutdown_timeout seconds
+        """
+        self._stop_event.set()
+        with self._lock:
+            processes = list(self._processes.values())
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        remaining = self._supervisor.join(timeout=self.shutdown_timeout)
+        for name in remaining:
+            logging.warning("Process {} did not stop in time, killing it".format(name))
+            self._processes[name].kill()
+        self._supervisor.join()
+
+    def _add(self, name: str, target):
+        self._supervisor.add(name, lambda: self._run_process(name, target))
+
+    def _run_process(self, name: str, target):
+        with self._lock:
+            if self._stop_event.is_set():
+                return
+            process = self._context.Process(
+                target=target, args=(self.config_file,), name=name
+            )
+            process.start()
+            self._processes[name] = process
+        logging.info("Started process {} with pid {}".format(name, process.pid))
+        process.join()
+        if process.exitcode and not self._stop_event.is_set():
+            raise RuntimeError(
+                "Process {} exited with code {}".format(name, process.exitcode)
+            )
+
+
+def main():
+    config_file = runtime_config_file()
+    configure_logging()
+    config = Config.from_yaml(config_file)
+    processes_config = (config.server or {}).get("processes") or {}
+    ProcessSupervisor(
+        config_file,
+        api_workers=processes_config.get("api_workers") or 2,
+        watcher=processes_config.get("watcher", True),
+        shutdown_timeout=config.trainer_config.shutdown_timeout or 30,
+    ).run()
+
+
+if __name__ == "__main__":
+    main()
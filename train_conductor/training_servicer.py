@@ -14,100 +14,244 @@
 
 # Standard
 import datetime
-import importlib
 from uuid import uuid4
 import json
+import re
+import threading
+import time
 
 # First Party
 from aconfig import Config
 
 # Third Party
+from google.protobuf import timestamp_pb2
 from google.protobuf.message import Message as ProtoMessageType
-from grpc import ServicerContext
+from grpc import ServicerContext, StatusCode
 from google.protobuf.json_format import MessageToDict
 
 # Local
+from train_conductor.datastore.change_feed import ChangeFeed
+from train_conductor.datastore.database_base import RecordWrite
 from train_conductor.protobuf import trainconductor_pb2_grpc
-from train_conductor.protobuf.trainconductor_pb2 import TrainingStatusResponse, TrainingJob
-from train_conductor.types import TrainingStatus
-from train_conductor.utils.helpers import convert_timestamp
+from train_conductor.protobuf.trainconductor_pb2 import (
+    BatchTrainingResponse,
+    BatchTrainingStatusResponse,
+    ListTrainingsResponse,
+    TrainingStatusResponse,
+    TrainingJob,
+)
+from train_conductor.types import TrainingStatus, COMPLETED_STATES, MAX_PRIORITY
+from train_conductor.utils.helpers import convert_timestamp, load_db_helper_class
+from train_conductor.utils.lru_cache import LRUCache
 from train_conductor.utils import error_check as error
 
+# Statuses of jobs that may be waiting in the admission queue
+WAITING_STATES = [TrainingStatus.PLACEHOLDER_UNSET.name, TrainingStatus.QUEUED.name]
+
 
 class TrainingServicer(trainconductor_pb2_grpc.TrainConductorServicer):
     """Provides methods that implement functionality of training servicer"""
 
     def __init__(self, config: Config):
         self.config = config
-        db_helper_cls = getattr(
-            importlib.import_module(self.config.datastore.helper_module_path),
-            self.config.datastore.helper_class,
-        )
-        self.db_client = db_helper_cls(self.config)
+        self.db_client = load_db_helper_class(self.config)(self.config)
+
+        # Queue positions and start estimates come from the admission queue, so
+        # they are only given when admission is enabled
+        admission_config = self.config.trainer_config.admission or {}
+        self._admission_enabled = bool(admission_config.get("enabled"))
+
+        server_config = self.config.server or {}
+        # Train is refused while this many jobs wait for admission, 0 for no limit
+        self._max_backlog = server_config.get("max_backlog") or 0
+        self._backlog_retry_after = server_config.get("backlog_retry_after") or 60
+        # Run time statistics are shared by all requests for this many seconds
+        self._stats_ttl = server_config.get("queue_stats_ttl") or 30
+        self._stats = None
+        self._stats_expiry = 0
+        self._stats_lock = threading.Lock()
+
+        # All watch streams of the process share one change listener
+        self._change_feed = ChangeFeed(self.db_client)
+
+        # Status responses are reused until the job changes. Queue positions
+        # and start estimates of waiting jobs may be up to ttl seconds old.
+        cache_config = server_config.get("status_cache") or {}
+        self._status_cache = None
+        if cache_config.get("max_size"):
+            self._status_cache = LRUCache(
+                cache_config.get("max_size"), cache_config.get("ttl") or 10
+            )
+            self._change_feed.add_listener(self._status_cache.invalidate)
+        self._max_watch_ids = server_config.get("max_watch_ids") or 1000
+        # How often a watch stream checks whether its client went away
+        self._watch_poll_interval = server_config.get("watch_poll_interval") or 5
+        # Most jobs a batch call can submit or look up
+        self._max_batch_size = server_config.get("max_batch_size") or 1000
+        self._default_page_size = server_config.get("default_page_size") or 100
+        self._max_page_size = server_config.get("max_page_size") or 1000
 
     def Train(self, request: ProtoMessageType, context: ServicerContext):
         """Fine-tune a model using HF SFT Trainer"""
+        self._check_backlog(context, 1)
         try:
-            job_id = str(uuid4())
-            request_dict = MessageToDict(request, preserving_proto_field_name=True)
-            param_dict = request_dict.get("parameters")
-
-            self._validate_train_params(param_dict)
+            job_id, record = self._training_record(request)
+            self.db_client.write_record(job_id, record)
+            return TrainingJob(training_id=job_id, model_name=record.get("model_name"))
+        except Exception as err:
+            raise Exception("Unhandled exception during training") from err
 
-            param_dict["output_dir"] = (
-                request_dict.get("output_path") or self.config.trainer_config.output_dir
-            ) + "/" + request_dict.get("model_name")
-            params = json.dumps(param_dict, indent=4)
-            request_dict.pop("parameters")
-            request_dict.update(
-                {"parameters": params, "status": TrainingStatus.PLACEHOLDER_UNSET.name}
+    def BatchTrain(self, request: ProtoMessageType, context: ServicerContext):
+        """Fine-tune several models at once"""
+        self._check_backlog(context, len(request.requests))
+        try:
+            error.value_check(
+                "<TCD71502287E>",
+                0 < len(request.requests) <= self._max_batch_size,
+                "between 1 and {} trainings can be requested at once",
+                self._max_batch_size,
+            )
+            # Every request is validated before any job is written
+            records = [self._training_record(r) for r in request.requests]
+            self.db_client.write_batch(
+                [RecordWrite(job_id, record) for job_id, record in records]
             )
-            self.db_client.write_record(job_id, request_dict)
-            return TrainingJob(
-                training_id=job_id, model_name=request_dict.get("model_name")
+            return BatchTrainingResponse(
+                jobs=[
+                    TrainingJob(training_id=job_id, model_name=record.get("model_name"))
+                    for job_id, record in records
+                ]
             )
         except Exception as err:
-            raise Exception("Unhandled exception during training") from err
+            raise Exception("Unhandled exception during batch training") from err
 
     def GetTrainingStatus(self, request: ProtoMessageType, context: ServicerContext):
         """Get the status of a training job"""
         try:
-            training_info = self.db_client.read_record(request.training_id)
-            submission_timestamp = training_info.get("submission_timestamp")
-            completion_timestamp = training_info.get("completion_timestamp")
-            return TrainingStatusResponse(
-                training_id=request.training_id,
-                state=training_info.get("status"),
-                reasons=[training_info.get("errors")]
-                if training_info.get("errors")
-                else [],
-                submission_timestamp=convert_timestamp(submission_timestamp)
-                if submission_timestamp
-                else None,
-                completion_timestamp=convert_timestamp(completion_timestamp)
-                if completion_timestamp
-                else None,
-            )
+            if self._status_cache is not None:
+                return self._status_cache.get_or_load(
+                    request.training_id,
+                    lambda: self._read_status(request.training_id),
+                )
+            return self._read_status(request.training_id)
         except Exception as err:
             raise Exception(
                 "Failed to get status for training id {}".format(request.training_id)
             ) from err
 
+    def BatchGetTrainingStatus(
+        self, request: ProtoMessageType, context: ServicerContext
+    ):
+        """Get the status of several training jobs"""
+        training_ids = list(dict.fromkeys(request.training_ids))
+        try:
+            error.value_check(
+                "<TCD71502288E>",
+                len(training_ids) <= self._max_batch_size,
+                "at most {} training ids can be requested at once",
+                self._max_batch_size,
+            )
+            records = self.db_client.read_many_entries(training_ids)
+            return BatchTrainingStatusResponse(statuses=self._status_responses(records))
+        except Exception as err:
+            raise Exception("Failed to get status of training ids") from err
+
+    def ListTrainings(self, request: ProtoMessageType, context: ServicerContext):
+        """List training jobs, a page at a time"""
+        try:
+            states = [TrainingStatus(state).name for state in request.states]
+            page_size = min(
+                request.page_size or self._default_page_size, self._max_page_size
+            )
+            index, cursor = self._parse_page_token(request.page_token)
+
+            # Keys come from the model index if there is a model filter, else
+            # from the index of each state in turn
+            if request.model_name:
+                sources = [request.model_name]
+                list_keys = self.db_client.list_by_model
+            else:
+                sources = states or [status.name for status in TrainingStatus]
+                list_keys = self.db_client.list_by_status
+
+            keys = []
+            while index < len(sources) and len(keys) < page_size:
+                cursor, batch = list_keys(
+                    sources[index], cursor=cursor, count=page_size - len(keys)
+                )
+                keys.extend(batch)
+                if not int(cursor):
+                    index += 1
+
+            records = {
+                key: record
+                for key, record in self.db_client.read_many_entries(keys).items()
+                # Records may have moved on since they were listed
+                if record and (not states or record.get("status") in states)
+            }
+            next_page_token = ""
+            if index < len(sources):
+                next_page_token = "{}:{}".format(index, cursor)
+            return ListTrainingsResponse(
+                trainings=self._status_responses(records),
+                next_page_token=next_page_token,
+            )
+        except Exception as err:
+            raise Exception("Failed to list trainings") from err
+
+    def WatchTrainingStatus(self, request: ProtoMessageType, context: ServicerContext):
+        """Stream the status of training jobs as it changes"""
+        training_ids = list(dict.fromkeys(request.training_ids))
+        try:
+            self._check_watch_ids(training_ids)
+            # Subscribe first, so that no change after the initial read is missed
+            subscription = self._change_feed.subscribe(training_ids)
+        except Exception as err:
+            raise Exception("Failed to watch training status") from err
+
+        context.add_callback(subscription.close)
+        try:
+            records = self.db_client.read_many_entries(training_ids)
+            self._check_watched_exist(training_ids, records)
+
+            sent = {}
+            while True:
+                changed = self._status_changes(records, sent)
+                yield from self._status_responses(changed)
+                if self._all_finished(training_ids, sent):
+                    return
+                if subscription.closed or not context.is_active():
+                    return
+                records = subscription.get(self._watch_poll_interval)
+        except Exception as err:
+            raise Exception(
+                "Failed to watch status of training ids {}".format(
+                    ", ".join(training_ids)
+                )
+            ) from err
+        finally:
+            subscription.close()
+
     def CancelTraining(self, request: ProtoMessageType, context: ServicerContext):
         """Cancel a training job."""
         try:
-            self.db_client.write_field(
-                request.training_id, "status", TrainingStatus.CANCELED.name
+            # Jobs that already finished keep their final status
+            _, training_info = self.db_client.transition_status(
+                request.training_id, TrainingStatus.CANCELED
+            )
+            error.value_check(
+                "<TCD71502284E>",
+                training_info,
+                "training id {} does not exist",
+                request.training_id,
             )
-
-            training_info = self.db_client.read_record(request.training_id)
 
             return TrainingStatusResponse(
                 training_id=request.training_id,
                 state=training_info.get("status"),
-                reasons=[str(error) for error in training_info.get("errors")]
-                if training_info.get("errors")
-                else [],
+                reasons=(
+                    [training_info.get("errors")] if training_info.get("errors") else []
+                ),
             )
         except Exception as err:
             raise Exception(
@@ -116,12 +260,238 @@ class TrainingServicer(trainconductor_pb2_grpc.TrainConductorServicer):
                 )
             ) from err
 
+    def stop(self):
+        """
+        End all watch streams
+        """
+        self._change_feed.stop()
+
+    def _check_backlog(self, context: ServicerContext, new_jobs: int):
+        """
+        Abort with RESOURCE_EXHAUSTED if new_jobs more jobs would not fit in
+        the admission backlog
+        """
+        if not self._max_backlog:
+            return
+        if self.db_client.count_backlog() + new_jobs > self._max_backlog:
+            retry_after = self._estimate_wait(0) or self._backlog_retry_after
+            context.set_trailing_metadata((("retry-after", str(int(retry_after))),))
+            context.abort(
+                StatusCode.RESOURCE_EXHAUSTED,
+                "Too many training jobs are waiting, try again in {} seconds".format(
+                    int(retry_after)
+                ),
+            )
+
+    def _training_record(self, request: ProtoMessageType):
+        """
+        Validate a TrainingRequest and return a new job ID and the record to
+        write for it
+        """
+        job_id = str(uuid4())
+        request_dict = MessageToDict(request, preserving_proto_field_name=True)
+        param_dict = request_dict.get("parameters")
+
+        self._validate_train_params(param_dict)
+        self._validate_admission_params(request_dict)
+
+        param_dict["output_dir"] = (
+            (request_dict.get("output_path") or self.config.trainer_config.output_dir)
+            + "/"
+            + request_dict.get("model_name")
+        )
+        params = json.dumps(param_dict, indent=4)
+        request_dict.pop("parameters")
+        request_dict.update(
+            {
+                "parameters": params,
+                "status": TrainingStatus.PLACEHOLDER_UNSET.name,
+                # Orders jobs of the same priority in the admission queue
+                "created_at": time.time(),
+            }
+        )
+        return job_id, request_dict
+
+    @staticmethod
+    def _parse_page_token(page_token: str):
+        """
+        Return the index of the key source and the cursor within it that a
+        page token points to
+        """
+        if not page_token:
+            return 0, 0
+        error.value_check(
+            "<TCD71502289E>",
+            re.fullmatch(r"\d+:\d+", page_token),
+            "invalid page token {}",
+            page_token,
+        )
+        index, cursor = page_token.split(":")
+        return int(index), int(cursor)
+
+    def _read_status(self, training_id: str):
+        training_info = self.db_client.read_record(training_id)
+        return self._status_responses({training_id: training_info})[0]
+
+    def _check_watch_ids(self, training_ids: list):
+        error.value_check(
+            "<TCD71502285E>",
+            0 < len(training_ids) <= self._max_watch_ids,
+            "between 1 and {} training ids can be watched at once",
+            self._max_watch_ids,
+        )
+
+    @staticmethod
+    def _check_watched_exist(training_ids: list, records: dict):
+        for training_id in training_ids:
+            error.value_check(
+                "<TCD71502286E>",
+                records.get(training_id),
+                "training id {} does not exist",
+                training_id,
+            )
+
+    @staticmethod
+    def _status_changes(records: dict, sent: dict) -> dict:
+        """
+        Return the records whose status, errors or completion time differ from
+        what was last sent for them, and note them as sent
+        """
+        changed = {}
+        for training_id, training_info in records.items():
+            if not training_info:
+                continue
+            status = (
+                training_info.get("status"),
+                training_info.get("errors"),
+                training_info.get("completion_timestamp"),
+            )
+            # Changes to other fields of the record are not sent
+            if sent.get(training_id) == status:
+                continue
+            sent[training_id] = status
+            changed[training_id] = training_info
+        return changed
+
+    @staticmethod
+    def _all_finished(training_ids: list, sent: dict) -> bool:
+        finished = [
+            training_id
+            for training_id, (status, _, _) in sent.items()
+            if status and TrainingStatus[status] in COMPLETED_STATES
+        ]
+        return len(finished) == len(training_ids)
+
+    def _waiting(self, records: dict) -> list:
+        """
+        Return the IDs of the records that may be in the admission queue, none
+        if admission is disabled
+        """
+        if not self._admission_enabled:
+            return []
+        return [
+            training_id
+            for training_id, training_info in records.items()
+            if training_info.get("status") in WAITING_STATES
+        ]
+
+    def _status_responses(self, records: dict) -> list:
+        """
+        Build a TrainingStatusResponse for each record, by key. The queue
+        positions of waiting jobs are read all at once.
+        """
+        waiting = self._waiting(records)
+        positions = self.db_client.admission_positions(waiting) if waiting else {}
+        return [
+            self._status_response(
+                training_id, training_info, positions.get(training_id)
+            )
+            for training_id, training_info in records.items()
+        ]
+
+    def _status_response(
+        self, training_id: str, training_info: dict, queue_position: int = None
+    ):
+        submission_timestamp = training_info.get("submission_timestamp")
+        completion_timestamp = training_info.get("completion_timestamp")
+
+        estimated_start = None
+        if queue_position is not None:
+            wait = self._estimate_wait(queue_position)
+            if wait is not None:
+                estimated_start = timestamp_pb2.Timestamp(
+                    seconds=int(time.time() + wait)
+                )
+
+        return TrainingStatusResponse(
+            training_id=training_id,
+            state=training_info.get("status"),
+            reasons=(
+                [training_info.get("errors")] if training_info.get("errors") else []
+            ),
+            submission_timestamp=(
+                convert_timestamp(submission_timestamp)
+                if submission_timestamp
+                else None
+            ),
+            completion_timestamp=(
+                convert_timestamp(completion_timestamp)
+                if completion_timestamp
+                else None
+            ),
+            queue_position=queue_position,
+            estimated_start_timestamp=estimated_start,
+        )
+
+    def _estimate_wait(self, jobs_ahead: int) -> float:
+        """
+        Estimate how many seconds a job with jobs_ahead jobs in front of it waits
+        to start, assuming jobs keep finishing at the rate the running ones do.
+        Returns None without recent run times to go by.
+        """
+        average_duration, running = self._queue_stats()
+        if not average_duration:
+            return None
+        return (jobs_ahead + 1) * average_duration / max(running, 1)
+
+    def _queue_stats(self):
+        """
+        Return the average run time of recent jobs and the number of running jobs
+        """
+        with self._stats_lock:
+            if time.monotonic() >= self._stats_expiry:
+                durations = self.db_client.read_durations()
+                self._stats = (
+                    sum(durations) / len(durations) if durations else None,
+                    self.db_client.count_by_status(TrainingStatus.RUNNING),
+                )
+                self._stats_expiry = time.monotonic() + self._stats_ttl
+            return self._stats
+
     def _convert_timestamp(self, ts_str):
         ts_dt = datetime.strptime(ts_str, "%m/%d/%Y %H:%M:%S")
         return timestamp_pb2.Timestamp(
             seconds=int(ts_dt.timestamp()), nanos=int(ts_dt.microsecond * 1e3)
         )
 
+    def _validate_admission_params(self, request_dict):
+        tenant = request_dict.get("tenant")
+        if tenant:
+            # The tenant is set as a label on the Kubernetes job
+            error.value_check(
+                "<TCD37116526E>",
+                re.fullmatch(r"[A-Za-z0-9]([-A-Za-z0-9_.]{0,61}[A-Za-z0-9])?", tenant),
+                "tenant has to be a valid Kubernetes label value",
+            )
+        priority = request_dict.get("priority") or 0
+        error.value_check(
+            "<TCD37116527E>",
+            -MAX_PRIORITY <= priority <= MAX_PRIORITY,
+            "priority has to be between {} and {}",
+            -MAX_PRIORITY,
+            MAX_PRIORITY,
+        )
+
     def _validate_train_params(self, request_parameters):
         num_train_epochs = request_parameters.get("num_train_epochs")
         per_device_train_batch_size = request_parameters.get(
@@ -42,3 +42,50 @@ COMPLETED_STATES = [
     TrainingStatus.FAILED,
     TrainingStatus.SUSPENDED,
 ]
+
+# Status changes allowed by DatabaseBase.transition_status, keyed by the current status
+VALID_TRANSITIONS = {
+    TrainingStatus.PLACEHOLDER_UNSET: [
+        TrainingStatus.PENDING,
+        TrainingStatus.QUEUED,
+        TrainingStatus.RUNNING,
+        TrainingStatus.COMPLETED,
+        TrainingStatus.CANCELED,
+        TrainingStatus.FAILED,
+    ],
+    TrainingStatus.PENDING: [
+        TrainingStatus.QUEUED,
+        TrainingStatus.RUNNING,
+        TrainingStatus.COMPLETED,
+        TrainingStatus.CANCELED,
+        TrainingStatus.FAILED,
+    ],
+    TrainingStatus.QUEUED: [
+        TrainingStatus.PENDING,
+        TrainingStatus.RUNNING,
+        TrainingStatus.COMPLETED,
+        TrainingStatus.CANCELED,
+        TrainingStatus.FAILED,
+    ],
+    TrainingStatus.RUNNING: [
+        TrainingStatus.SUSPENDED,
+        TrainingStatus.COMPLETED,
+        TrainingStatus.CANCELED,
+        TrainingStatus.FAILED,
+    ],
+    TrainingStatus.SUSPENDED: [
+        TrainingStatus.QUEUED,
+        TrainingStatus.RUNNING,
+        TrainingStatus.COMPLETED,
+        TrainingStatus.CANCELED,
+        TrainingStatus.FAILED,
+    ],
+    TrainingStatus.COMPLETED: [TrainingStatus.DELETED],
+    TrainingStatus.CANCELED: [TrainingStatus.DELETED],
+    TrainingStatus.FAILED: [TrainingStatus.DELETED],
+    TrainingStatus.DELETED: [],
+}
+
+# Bound of the priority of a job in the admission queue, either way. Keeps the
+# admission score within the integers a double represents exactly.
+MAX_PRIORITY = 100
@@ -14,13 +14,56 @@
 
 # Standard
 from datetime import datetime
+import importlib
+import logging
+import os
+import sys
 
 # Third Party
 from google.protobuf import timestamp_pb2
 
+# Local
+from train_conductor.utils import error_check
+
 
 def convert_timestamp(ts_str):
     ts_dt = datetime.strptime(ts_str, "%m/%d/%Y %H:%M:%S")
     return timestamp_pb2.Timestamp(
         seconds=int(ts_dt.timestamp()), nanos=int(ts_dt.microsecond * 1e3)
     )
+
+
+def runtime_config_file() -> str:
+    """
+    Path of the runtime config, from RUNTIME_CONFIG_FILE or else runtime_config.yml
+    """
+    config_file = os.environ.get("RUNTIME_CONFIG_FILE") or "runtime_config.yml"
+    error_check.file_check("<TCD74240296E>", config_file)
+    return config_file
+
+
+def configure_logging():
+    """
+    Log INFO and above to stdout, as the entry points do
+    """
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setLevel(logging.INFO)
+    formatter = logging.Formatter(
+        "%(asctime)s - %(name)s - %(levelname)s - %(process)d - %(message)s"
+    )
+    handler.setFormatter(formatter)
+    root.addHandler(handler)
+
+
+def load_db_helper_class(config, class_option: str = "helper_class"):
+    """
+    Import the datastore helper class named by the class_option of the
+    datastore config, from its helper_module_path
+    """
+    return getattr(
+        importlib.import_module(config.datastore.helper_module_path),
+        config.datastore.get(class_option),
+    )
@@ -0,0 +1,120 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+from collections import OrderedDict
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Thread safe cache of at most max_size values, each kept for at most ttl
+    seconds. The least recently used value is evicted first.
+
+    A value loaded while its key is invalidated is returned to the caller but
+    not cached, so an invalidation is never undone by a load that read the
+    data before the change.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        # Values by key, as (value, expiry), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # Invalidations are numbered so that loads can tell if they missed one
+        self._generation = 0
+        # Number of loads in progress by key
+        self._loading = {}
+        # Generation of the last invalidation of keys being loaded
+        self._invalidated = {}
+
+    def get_or_load(self, key, load):
+        """
+        Return the cached value of key, or else the value returned by load(),
+        which is cached
+        """
+        found, value, generation = self._lookup(key)
+        if found:
+            return value
+        try:
+            value = load()
+        except BaseException:
+            self._store(key, None, None)
+            raise
+        self._store(key, value, generation)
+        return value
+
+    async def get_or_load_async(self, key, load):
+        """
+        Like get_or_load, for a load function that returns an awaitable
+        """
+        found, value, generation = self._lookup(key)
+        if found:
+            return value
+        try:
+            value = await load()
+        except BaseException:
+            self._store(key, None, None)
+            raise
+        self._store(key, value, generation)
+        return value
+
+    def _lookup(self, key):
+        """
+        Return whether key is cached and its value. If not, a load of key
+        starts, with the returned generation, and must end with _store.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                return True, entry[0], None
+            self._loading[key] = self._loading.get(key, 0) + 1
+            return False, None, self._generation
+
+    def _store(self, key, value, generation):
+        """
+        End a load of key, caching its value unless key was invalidated since
+        the load started or the generation is None
+        """
+        with self._lock:
+            if generation is not None and self._invalidated.get(key, -1) <= generation:
+                self._entries[key] = (value, time.monotonic() + self.ttl)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            self._loading[key] -= 1
+            if not self._loading[key]:
+                del self._loading[key]
+                self._invalidated.pop(key, None)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+            if key in self._loading:
+                self._generation += 1
+                self._invalidated[key] = self._generation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+            for key in self._loading:
+                self._invalidated[key] = self._generation
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
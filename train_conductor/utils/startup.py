@@ -0,0 +1,48 @@
+# Copyright The Train Conductor Authors
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Standard
+import logging
+import time
+
+
+class StartupTimer:
+    """
+    Measures how long each phase of startup takes, from started, a
+    time.monotonic() value, or else from when the timer is created
+    """
+
+    def __init__(self, started: float = None):
+        self.started = started or time.monotonic()
+        self.phases = []
+        self._last = self.started
+
+    def mark(self, phase: str):
+        """
+        Note that phase ended now. It started when the previous one ended.
+        """
+        now = time.monotonic()
+        self.phases.append((phase, now - self._last))
+        self._last = now
+
+    def report(self):
+        logging.info(
+            "Ready {:.3f}s after startup: {}".format(
+                self._last - self.started,
+                ", ".join(
+                    "{} {:.3f}s".format(phase, seconds)
+                    for phase, seconds in self.phases
+                ),
+            )
+        )